@@ -1,8 +1,21 @@
 import argparse
+import functools
 import json
 from pathlib import Path
 
 from src.openmeteo import *
+from src.ratelimit import *
+from src.http_client import *
+from src.manifest import *
+from src.openmeteo_deltas import *
+from src.consolidate import *
+from src.packing import *
+from src.reshape import *
+from src.hdfs_stream import *
+from src.hdfs_client import *
+from src.hdfs_sync import *
+from src.replication import *
+from src.pipeline import *
 from src.hadoop import *
 from src.kaggle import *
 from src.utils import *
@@ -24,30 +37,50 @@ logger.setLevel(logging.INFO)
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
-def execute_command_chain(commands):
-    for command in commands:
-        run_local_command(command, logger)
+def upload_yearly_openmeteo_data(year, manifest, hdfs, packed_dir, hdfs_target_dir, sync_cache_dir,
+                                 replication_factor=None, replication_verifier=None):
+    # The station files of a year are packed into block-sized files before they reach HDFS,
+    # which keeps the NameNode from tracking hundreds of tiny files per year
+    pending = manifest.pending_uploads(year)
+    if not pending:
+        logger.info(f'No new weather files for {year}')
+        return True
 
-def set_replication_factor(container_name, hdfs_target_dir):
-    command = set_replication_factor_command(container_name, hdfs_target_dir, 3)
-    run_local_command(command, logger)
+    packed_year_dir = pack_open_meteo_year(year, manifest, packed_dir, logger)
+    # Per-station files from earlier layouts are orphans of the packed directory and get removed
+    report = sync_to_hdfs(hdfs, packed_year_dir, hdfs_target_dir, sync_cache_dir, logger, delete_orphans=True,
+                          replication=replication_factor)
+    if replication_verifier and (report['added'] or report['modified']):
+        replication_verifier.watch(hdfs_target_dir)
+    if report['failed']:
+        return False
 
-def upload_to_hadoop(container_name, local_source_dir, hdfs_target_dir, staging_dir_in_container):
-    commands = [
-        create_hdfs_directory_command(container_name, hdfs_target_dir),
-        copy_files_to_docker_command(container_name, local_source_dir, staging_dir_in_container),
-        upload_to_hdfs_command(container_name, hdfs_target_dir, staging_dir_in_container),
-    ]
-    
-    execute_command_chain(commands)
+    with open(os.path.join(packed_year_dir, f"openmeteo_{year}.index.json"), 'r', encoding='utf-8') as f:
+        packed_index = json.load(f)
+    for row in pending:
+        packed_file = packed_index['stations'][row['station_id']]['file']
+        manifest.record_upload(row['station_id'], year, f"{hdfs_target_dir}/{packed_file}")
+    logger.info(f'Uploaded {len(pending)} weather files for {year} as {len(packed_index["files"])} packed files')
+    return True
 
-def upload_yearly_openmeteo_data(year, openmeteo_dir, hdfs_target_dir, container_name, staging_dir_in_container):
-    local_source_dir = openmeteo_dir.joinpath(f"{year}")
-    
-    upload_to_hadoop(container_name, local_source_dir, hdfs_target_dir, staging_dir_in_container)
+def upload_openmeteo_deltas(year, manifest, hdfs, hdfs_target_dir, replication_factor=None):
+    # Returns the number of deltas uploaded
+    pending = manifest.pending_delta_uploads(year)
+    if not pending:
+        logger.info(f'No new weather deltas for {year}')
+        return 0
 
-def upload_kaggle_data(kaggle_dir, hdfs_target_dir, container_name, staging_dir_in_container):   
-    upload_to_hadoop(container_name, kaggle_dir, hdfs_target_dir, staging_dir_in_container)
+    transfers = [(row['path'], f"{hdfs_target_dir}/{os.path.basename(row['path'])}") for row in pending]
+    # The directory and all deltas go through one batched HDFS session
+    hdfs.mkdirs([hdfs_target_dir])
+    results = hdfs.put_many(transfers, replication_factor)
+    uploaded = 0
+    for local_path, hdfs_path in transfers:
+        if results.get(hdfs_path):
+            manifest.record_delta_upload(local_path, hdfs_path)
+            uploaded += 1
+    logger.info(f'Uploaded {uploaded} of {len(pending)} weather deltas for {year}')
+    return uploaded
 
 def main():
     # 1. Inputs
@@ -67,88 +100,204 @@ def main():
         'joint_data_2017-2023/SO2_1g_joint_2017-2023.csv'
     ]
     air_quality_kaggle_dir = base_output_dir.joinpath('air_quality_kaggle')
-    kaggle_temp_dir = air_quality_kaggle_dir.joinpath('temp')
+    # Kept outside the uploaded directory, the cached archive must not reach HDFS
+    kaggle_temp_dir = base_output_dir.joinpath('kaggle_cache')
     stations_metadata_file = air_quality_kaggle_dir.joinpath(files_to_download_from_kaggle[0])
-    example_pm10_file = air_quality_kaggle_dir.joinpath(files_to_download_from_kaggle[3])
     stations_lat_lon_file = air_quality_kaggle_dir.joinpath('stations_lat_long.csv')
+    joint_files = [air_quality_kaggle_dir.joinpath(file) for file in files_to_download_from_kaggle[1:]]
+    air_quality_long_dir = base_output_dir.joinpath('air_quality_long')
 
     openmeteo_dir = base_output_dir.joinpath('openmeteo')
+    openmeteo_packed_dir = openmeteo_dir.joinpath('packed')
+    manifest_file = base_output_dir.joinpath('manifest.sqlite')
+    hdfs_sync_cache_dir = base_output_dir.joinpath('.hdfs_sync')
 
     # Hadoop config
     hadoop_base_target = '/user/hadoop'
     container_name = "master"
-    staging_dir_in_container = "/tmp/staging_data"
+    # 'docker' (hdfs CLI in the container), 'webhdfs' or 'local'
+    hdfs_backend = 'docker'
+    webhdfs_url = 'http://localhost:9870'
+    hdfs_user = 'hadoop'
+    # Files are written with this factor, DataNodes catch up in the background
+    replication_factor = 3
+    hdfs = create_hdfs_client(hdfs_backend, logger, container_name=container_name, namenode_url=webhdfs_url,
+                              user=hdfs_user, root_dir=str(base_output_dir.joinpath('hdfs_local')))
+    replication_verifier = ReplicationVerifier(hdfs, logger)
 
-    # 2. Download files from Kaggle
+    def watch_replication(report, hdfs_target_dir):
+        # Only directories that received files have blocks to replicate
+        if report['added'] or report['modified']:
+            replication_verifier.watch(hdfs_target_dir)
 
-    download_files_from_kaggle(kaggle_dataset_url, files_to_download_from_kaggle, kaggle_temp_dir,
-                                air_quality_kaggle_dir, logger)
+    # Pipeline state
+    pipeline_checkpoint_file = base_output_dir.joinpath('.pipeline_checkpoint.json')
+    manifest = DownloadManifest(manifest_file)
+    rate_limiter = RateLimiter()
+    session = create_session(max_connections_per_host=8)
+
+    # Every step below is a task of a DAG. Independent tasks run concurrently, so Kaggle uploads
+    # overlap the weather downloads and the years are consolidated and uploaded side by side.
+    pipeline = Pipeline(logger, pipeline_checkpoint_file, max_workers=6)
+
+    # 2. Download files from Kaggle
+    def download_kaggle():
+        download_selected_files_from_kaggle(kaggle_dataset_url, files_to_download_from_kaggle, kaggle_temp_dir,
+                                            air_quality_kaggle_dir, logger)
 
     # 3. Extract lat lon for relevant stations
-    logger.info('Extracting lat and lon of stations')
-    extract_lat_lon( \
-        example_pm10_file, \
-        stations_metadata_file, \
-        stations_lat_lon_file, \
-        logger
+    def extract_stations():
+        logger.info('Extracting lat and lon of stations')
+        extract_lat_lon( \
+            joint_files, \
+            stations_metadata_file, \
+            stations_lat_lon_file, \
+            logger
+            )
+        logger.info(green('Extracted!\n'))
+
+    # 3.1 Reshape the wide pollutant matrices into long records partitioned by year and station
+    def reshape_air_quality():
+        logger.info('Reshaping air quality data to long format')
+        reshape_joint_files_to_long(joint_files, air_quality_long_dir, logger)
+
+    # 4. Accumulate Open Meteo API data for historical weather, one partition per year.
+    # All years go in one task: a request covers the whole missing range of its stations and is split per year.
+    def download_openmeteo():
+        logger.info(f'Accumulating Open Meteo API readings for {", ".join(str(year) for year in years)}')
+        all_downloaded = download_open_meteo_measurements( \
+            stations_lat_lon_file, \
+            openmeteo_dir, \
+            years, \
+            logger, \
+            rate_limiter, \
+            batch_size=3, \
+            session=session, \
+            compression='gzip', \
+            manifest=manifest, \
+            grid_resolution=GRID_RESOLUTION
         )
-    logger.info(green('Extracted!\n'))
+        if not all_downloaded:
+            logger.warning('Some Open Meteo files could not be downloaded')
+        logger.info(green("Open Meteo files downloaded!\n"))
+
+    def report_downloads():
+        file_count, total_size = manifest.summary()
+        logger.info(f"Downloaded a total of {file_count} CSV files, totaling {total_size / (1024 ** 2):.2f} MB")
+
+    # 4.1 Consolidate a year with new station files into one columnar file
+    def consolidate_year(year):
+        if manifest.pending_uploads(year):
+            logger.info(f'Consolidating weather data for {year}...')
+            consolidate_open_meteo_year(year, manifest, openmeteo_dir, logger)
 
-    # 4. Accumulate Open Meteo API data for historical weather
-    logger.info('Accumulating Open Meteo API readings')
-    fail_delay = 10
-    for year in years:
-        all_downloaded = False
-        while all_downloaded == False:
-            all_downloaded = download_open_meteo_yearly_measurements( \
-                stations_lat_lon_file, \
-                openmeteo_dir, \
-                year, \
-                10, \
-                logger
-            )
-            if not all_downloaded:
-                logger.warning(f'Rate limit! Waiting {fail_delay} seconds and retrying')
-                time.sleep(fail_delay)
-
-    logger.info(green("Open Meteo files downloaded!\n"))
-    total_size = 0
-    file_count = 0
-    for dirpath, dirnames, filenames in os.walk(openmeteo_dir):
-        for f in filenames:
-            if f.endswith('.csv'):
-                fp = os.path.join(dirpath, f)
-                if os.path.isfile(fp):
-                    total_size += os.path.getsize(fp)
-                    file_count += 1
-
-    logger.info(f"Downloaded a total of {file_count} CSV files, totaling {total_size / (1024 ** 2):.2f} MB")
     # 5. Upload all the data into hadoop
     # 5.1 Upload kaggle
     kaggle_hdfs_target_dir = f"{hadoop_base_target}/kaggle"
+    air_quality_long_hdfs_target_dir = f"{hadoop_base_target}/air_quality_long"
+
+    def upload_kaggle():
+        logger.info('Uploading air quality data to hadoop...')
+        # Only files added or changed since the last sync are transferred
+        kaggle_files_to_upload = files_to_download_from_kaggle + [stations_lat_lon_file.name]
+        report = sync_to_hdfs(hdfs, air_quality_kaggle_dir, kaggle_hdfs_target_dir, hdfs_sync_cache_dir, logger, \
+                              files=kaggle_files_to_upload, replication=replication_factor)
+        watch_replication(report, kaggle_hdfs_target_dir)
+        return not report['failed']
+
+    def upload_air_quality_long():
+        logger.info('Uploading long format air quality data to hadoop...')
+        report = sync_to_hdfs(hdfs, air_quality_long_dir, air_quality_long_hdfs_target_dir, hdfs_sync_cache_dir, \
+                              logger, delete_orphans=True, replication=replication_factor)
+        watch_replication(report, air_quality_long_hdfs_target_dir)
+        return not report['failed']
 
-    logger.info('Uploading air quality data to hadoop...')
-    upload_kaggle_data(air_quality_kaggle_dir, kaggle_hdfs_target_dir, container_name, staging_dir_in_container)
-    
     # 5.2 Upload openmeteo
-    logger.info('Uploading weather data to hadoop...')
-    for year in years:
+    def upload_openmeteo_year(year):
+        logger.info(f'Uploading weather data for {year} to hadoop...')
         openmeteo_hdfs_target_dir = f"{hadoop_base_target}/openmeteo/{year}"
-        upload_yearly_openmeteo_data(year, openmeteo_dir, openmeteo_hdfs_target_dir, container_name, staging_dir_in_container)
-        
-
-    # Kaggle replication factor
-    logger.info('Setting replication factor for air quality data...')
-    set_replication_factor(container_name, kaggle_hdfs_target_dir)
-    # Openmeteo replication factor
-    logger.info('Setting replication factor for OpenMeteo weather data...')
-    for year in years:
+        uploaded = upload_yearly_openmeteo_data(year, manifest, hdfs, openmeteo_packed_dir, openmeteo_hdfs_target_dir,
+                                                hdfs_sync_cache_dir, replication_factor, replication_verifier)
+        return uploaded
+
+    # 5.3 Upload consolidated weather data
+    def upload_consolidated():
+        consolidated_dir = openmeteo_dir.joinpath(CONSOLIDATED_DIR)
+        consolidated_files = [f"openmeteo_{year}.npz" for year in years
+                              if consolidated_dir.joinpath(f"openmeteo_{year}.npz").exists()]
+        if not consolidated_files:
+            return True
+        logger.info('Uploading consolidated weather data to hadoop...')
+        report = sync_to_hdfs(hdfs, consolidated_dir, f"{hadoop_base_target}/openmeteo/consolidated", \
+                              hdfs_sync_cache_dir, logger, files=consolidated_files, replication=replication_factor)
+        watch_replication(report, f"{hadoop_base_target}/openmeteo/consolidated")
+        return not report['failed']
+
+    # 7. Dynamic API data - hours of the current year missing since the last run
+    # Past years are in here until their last deltas are folded into the yearly file
+    delta_years = open_meteo_delta_years(manifest)
+
+    def update_current_year():
+        uploaded = True
+        for year in delta_years:
+            uploaded = update_year_with_deltas(year) and uploaded
+        return uploaded
+
+    def update_year_with_deltas(year):
         openmeteo_hdfs_target_dir = f"{hadoop_base_target}/openmeteo/{year}"
-        set_replication_factor(container_name, openmeteo_hdfs_target_dir)
+        deltas_hdfs_target_dir = f"{hadoop_base_target}/openmeteo/deltas/{year}"
+
+        logger.info(f'Fetching weather deltas for {year}...')
+        ingest_open_meteo_deltas(stations_lat_lon_file, openmeteo_dir, logger, manifest, rate_limiter, session,
+                                 batch_size=20, compression='gzip', year=year)
+        if upload_openmeteo_deltas(year, manifest, hdfs, deltas_hdfs_target_dir, replication_factor):
+            replication_verifier.watch(deltas_hdfs_target_dir)
+
+        # Weekly (or once the year is over) the deltas are folded into the yearly file, which
+        # replaces them in HDFS. They are only dropped once the yearly file is uploaded.
+        compacted_deltas = compact_open_meteo_deltas(openmeteo_dir, year, manifest, logger)
+        compacted_uploaded = upload_yearly_openmeteo_data(year, manifest, hdfs, openmeteo_packed_dir,
+                                                          openmeteo_hdfs_target_dir, hdfs_sync_cache_dir,
+                                                          replication_factor, replication_verifier)
+        if not compacted_uploaded:
+            return False
+        return remove_compacted_deltas(compacted_deltas, manifest, hdfs, logger)
 
-    # 7. TODO Setup dynamic API data in hadoop
-    pass
+    # 8. Re-replication ran alongside the pipeline, only what is left of its deadline is waited for
+    def verify_replication():
+        logger.info('Verifying replication of uploaded data...')
+        if not replication_verifier.wait():
+            return False
+        logger.info(green('Replication verified!\n'))
+
+    # Downloads, the delta update and the replication check are not checkpointed:
+    # the manifest already skips finished work, a rerun only retries what is missing.
+    # Consolidation and upload of a year always follow the download again, so retried files get uploaded.
+    pipeline.add('download_kaggle', download_kaggle)
+    pipeline.add('extract_stations', extract_stations, ['download_kaggle'])
+    pipeline.add('reshape_air_quality', reshape_air_quality, ['download_kaggle'])
+    uploads = [
+        pipeline.add('upload_kaggle', upload_kaggle, ['extract_stations']),
+        pipeline.add('upload_air_quality_long', upload_air_quality_long, ['reshape_air_quality'])
+    ]
+    download = pipeline.add('download_openmeteo', download_openmeteo, ['extract_stations'], checkpoint=False)
+    consolidations = []
+    for year in years:
+        consolidations.append(pipeline.add(f'consolidate_{year}', functools.partial(consolidate_year, year),
+                                           [download]))
+        uploads.append(pipeline.add(f'upload_openmeteo_{year}', functools.partial(upload_openmeteo_year, year),
+                                    [consolidations[-1]]))
+    pipeline.add('report_downloads', report_downloads, [download], checkpoint=False)
+    uploads.append(pipeline.add('upload_consolidated', upload_consolidated, consolidations))
+    # The yearly files taking deltas are packed by their own upload tasks first, if they are in scope
+    current_year_dependencies = ['extract_stations'] + [f'upload_openmeteo_{year}' for year in years
+                                                         if year in delta_years]
+    uploads.append(pipeline.add('update_current_year', update_current_year, current_year_dependencies,
+                                checkpoint=False))
+    pipeline.add('verify_replication', verify_replication, uploads, checkpoint=False)
 
+    if not pipeline.run():
+        raise RuntimeError('Pipeline failed, a rerun resumes after the last completed tasks')
 
 if __name__ == '__main__':
     main()
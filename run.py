@@ -1,16 +1,18 @@
+import hashlib
 import json
 import os
 import logging
-import tempfile
-import time
-import sys
 import paramiko
 import shutil
+import sys
 import zipfile
 from pathlib import Path
-from scp import SCPClient
 from posixpath import join as posix_join
 import argparse
+
+from src.remote_sync import sync_to_remote
+from src.ssh import SshCommandRunner
+from src.utils import run_local_command
 # ===================================================
 #              This script runs locally             #
 # ===================================================
@@ -28,6 +30,8 @@ private_key_path = hadoop_config["private_key_path"]
 container_name = "master"
 remote_path = f"/home/{ssh_user}/project"
 staging_dir_in_container = "/tmp/staging_data"
+command_runners = {}
+VENV_KEY_FILE = '.requirements_key'
 
 # Setup logging
 log_formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
@@ -53,78 +57,70 @@ def create_ssh_client(host, port, username, key_filepath):
     raise
 
 def execute_ssh_command(ssh_client, command, working_dir=None):
+  # Output of every running command is streamed as it arrives, see SshCommandRunner
   try:
-    # If a working directory is provided, prepend `cd {working_dir} &&` to the command
-    if working_dir:
-      command = f"cd {working_dir} && {command}"
-
-    # Run the command on the remote server
-    logger.info(f"Executing command: {command}")
-    stdin, stdout, stderr = ssh_client.exec_command(command)
-
-    # Continuously read from stdout and stderr without waiting for the end
-    while True:
-      # Check for new data from stdout
-      output = stdout.channel.recv(1024).decode('utf-8')
-      if output:
-        sys.stdout.write(output)  # Print live output to local console
-        sys.stdout.flush()
-
-      # Check for new data from stderr (if any)
-      error_output = stderr.channel.recv(1024).decode('utf-8')
-      if error_output:
-        sys.stderr.write(error_output)  # Print live errors to local console
-        sys.stderr.flush()
-
-      # Exit the loop once both stdout and stderr are done (process finished)
-      if stdout.channel.exit_status_ready() and stderr.channel.exit_status_ready():
-        break
-
-      # Sleep for a short period to avoid high CPU usage
-      time.sleep(0.1)
-
-    # Capture exit status after the process finishes
-    exit_status = stdout.channel.recv_exit_status()
-
-    if exit_status == 0:
-      logger.info(f"Command succeeded: {command}")
-    else:
-      logger.error(f"Command failed with exit status {exit_status}")
-
+    return command_runner(ssh_client).run(command, working_dir).exit_status
   except Exception as e:
     logger.error(f"Error executing command {command}: {e}")
     raise
 
-
-def prepare_temp_upload_dir(local_root, files, folders):
-  temp_dir = Path(tempfile.mkdtemp())
-
-  # Copy individual files
-  for file in files:
-    rel_path = file.relative_to(local_root)
-    target_path = temp_dir / rel_path
-    target_path.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(file, target_path)
-
-  # Copy full folders (recursively), ignoring __pycache__
-  for folder in folders:
-    rel_path = folder.relative_to(local_root)
-    target_path = temp_dir / rel_path
-    shutil.copytree(folder, target_path, ignore=shutil.ignore_patterns('__pycache__'))
-
-  return temp_dir
-
-def delete_project_folder(ssh_client, remote_path):
-  # Delete the project directory on the remote machine if it exists
-  delete_command = f"sudo rm -rf {remote_path}"
-  logger.info(f"Deleting existing project folder on remote: {remote_path}")
-  execute_ssh_command(ssh_client, delete_command)
-
-def install_python_venv_package(ssh_client):
-  # Install python3-venv package to enable virtual environment creation
-  install_venv_cmd = "sudo apt-get update && sudo apt-get install -y python3.11-venv"
+def command_runner(ssh_client):
+  # One runner per connection, so commands started in the background keep being drained
+  transport = ssh_client.get_transport()
+  if transport not in command_runners:
+    command_runners[transport] = SshCommandRunner(transport, logger)
+  return command_runners[transport]
+
+def install_python_venv_package(ssh_client, python_version):
+  # Install python3-venv package to enable virtual environment creation.
+  # Runs on its own channel in the background, wait for the returned command before using venv.
+  major_minor = '.'.join(python_version.split('.')[:2])
+  install_venv_cmd = f"sudo apt-get update && sudo apt-get install -y python{major_minor}-venv"
   logger.info("Installing python3-venv package on remote...")
-  execute_ssh_command(ssh_client, install_venv_cmd)
+  return command_runner(ssh_client).start(install_venv_cmd, label='apt')
+
+def probe_remote_python(ssh_client, remote_venv_path):
+  # Python version, machine, whether venv can bootstrap pip (python3-venv installed)
+  # and the requirements key of the existing venv, in one round trip
+  probe_cmd = (
+    "python3 -c \"import importlib.util, platform; print(platform.python_version()); print(platform.machine()); "
+    "print(int(importlib.util.find_spec('ensurepip') is not None))\"; "
+    f"cat {remote_venv_path}/{VENV_KEY_FILE} 2>/dev/null || true"
+  )
+  lines = command_runner(ssh_client).run(probe_cmd, echo=False, capture=True).stdout.split()
+  return {
+    'python_version': lines[0],
+    'machine': lines[1],
+    'has_venv_package': lines[2] == '1',
+    'venv_key': lines[3] if len(lines) > 3 else None
+  }
+
+def requirements_key(requirements_file, python_version, machine):
+  # The venv and the wheelhouse are valid as long as requirements and interpreter do not change
+  digest = hashlib.sha256()
+  digest.update(Path(requirements_file).read_bytes())
+  digest.update(f"{python_version}|{machine}".encode('utf-8'))
+  return digest.hexdigest()[:16]
+
+def build_wheelhouse(requirements_file, wheelhouse_dir, python_version, machine):
+  # Downloads binary wheels for the remote interpreter once; reused until the key changes.
+  # Returns False when some requirement has no wheel for that platform.
+  if wheelhouse_dir.joinpath('.complete').exists():
+    return True
+  shutil.rmtree(wheelhouse_dir, ignore_errors=True)
+  wheelhouse_dir.mkdir(parents=True)
+  major_minor = '.'.join(python_version.split('.')[:2])
+  platforms = ' '.join(f"--platform {tag}_{machine}" for tag in ('manylinux2014', 'manylinux_2_28', 'linux'))
+  download_cmd = (
+    f"{sys.executable} -m pip download -r {requirements_file} -d {wheelhouse_dir} --only-binary=:all: "
+    f"--implementation cp --python-version {major_minor} {platforms}"
+  )
+  logger.info(f"Building wheelhouse for Python {python_version} on {machine}...")
+  if not run_local_command(download_cmd, logger):
+    shutil.rmtree(wheelhouse_dir, ignore_errors=True)
+    return False
+  wheelhouse_dir.joinpath('.complete').touch()
+  return True
 
 def main():
   local_project_root = Path('.').resolve()
@@ -136,40 +132,69 @@ def main():
   folders_to_send = [
     local_project_root / 'src'
   ]
+  requirements_file = local_project_root / 'requirements.txt'
 
   # Connect via SSH
   logger.info(f"Connecting to {ssh_host}...")
   ssh = create_ssh_client(ssh_host, ssh_port, ssh_user, private_key_path)
-  scp = SCPClient(ssh.get_transport())
-
-  # Ensure the remote project directory is deleted
-  delete_project_folder(ssh, remote_path)
-
-  # Ensure remote upload directory exists
-  execute_ssh_command(ssh, f"mkdir -p {remote_path}")
+  sftp = ssh.open_sftp()
 
-  # Prepare clean upload dir preserving folder structure
-  temp_upload_dir = prepare_temp_upload_dir(local_project_root, files_to_send, folders_to_send)
+  def reconnect():
+    # Re-establishes the connection in place, interrupted uploads resume where they stopped
+    ssh.connect(ssh_host, port=ssh_port, username=ssh_user, key_filename=private_key_path)
 
-  # Upload files and folders
-  for item in temp_upload_dir.iterdir():
-    logger.info(f"Uploading structured files from: {item}")
-    scp.put(str(item), remote_path, recursive=item.is_dir())
-
-  # Ensure python3-venv is installed on the remote machine
-  install_python_venv_package(ssh)
-
-  # Create a virtual environment on the remote machine
+  # The venv is keyed on requirements.txt and the remote interpreter, an unchanged deploy skips
+  # apt, venv creation and pip entirely
   remote_venv_path = posix_join(remote_path, 'venv')
-  create_venv_cmd = f"python3 -m venv {remote_venv_path}"
-  logger.info("Creating virtual environment on remote machine...")
-  execute_ssh_command(ssh, create_venv_cmd, working_dir=remote_path)
-
-  # Install Python dependencies in the virtual environment
-  remote_req_path = posix_join(remote_path, 'requirements.txt')
-  install_cmd = f"{remote_venv_path}/bin/pip install -r {remote_req_path}"
-  logger.info("Installing Python dependencies on remote in virtual environment...")
-  execute_ssh_command(ssh, install_cmd, working_dir=remote_path)
+  remote_python = probe_remote_python(ssh, remote_venv_path)
+  venv_key = requirements_key(requirements_file, remote_python['python_version'], remote_python['machine'])
+  venv_up_to_date = remote_python['venv_key'] == venv_key
+
+  # Ensure python3-venv is installed on the remote machine, while the project is being uploaded
+  venv_package_install = None
+  if not venv_up_to_date and not remote_python['has_venv_package']:
+    venv_package_install = install_python_venv_package(ssh, remote_python['python_version'])
+
+  # Upload only files that changed since the last deploy, remove the ones deleted locally
+  logger.info(f"Deploying project to {remote_path}...")
+  sync_to_remote(sftp, local_project_root, files_to_send, folders_to_send, remote_path, logger, ssh_client=ssh,
+                 reconnect=reconnect)
+
+  if venv_up_to_date:
+    logger.info(f"Remote virtual environment is up to date ({venv_key}), skipping dependency setup")
+  else:
+    # Wheels are fetched locally and shipped, the remote install does not touch the network
+    wheelhouse_dir = local_project_root.joinpath('wheelhouse', venv_key)
+    remote_wheelhouse_path = posix_join(remote_path, 'wheelhouse')
+    offline = build_wheelhouse(requirements_file, wheelhouse_dir, remote_python['python_version'],
+                               remote_python['machine'])
+    if offline:
+      sync_to_remote(sftp, wheelhouse_dir, [], [wheelhouse_dir], remote_wheelhouse_path, logger, ssh_client=ssh,
+                     reconnect=reconnect)
+    else:
+      logger.warning('Some requirements have no wheels for the remote platform, installing from the network')
+
+    if venv_package_install and venv_package_install.channel.get_transport() is not ssh.get_transport():
+      # The connection was re-established during the uploads, the install started on the old one runs again
+      venv_package_install = install_python_venv_package(ssh, remote_python['python_version'])
+    if venv_package_install and command_runner(ssh).wait([venv_package_install])[0] != 0:
+      raise RuntimeError('Installing python3-venv failed')
+
+    # Create a virtual environment on the remote machine
+    create_venv_cmd = f"python3 -m venv --clear {remote_venv_path}"
+    logger.info("Creating virtual environment on remote machine...")
+    execute_ssh_command(ssh, create_venv_cmd, working_dir=remote_path)
+
+    # Install Python dependencies in the virtual environment
+    remote_req_path = posix_join(remote_path, 'requirements.txt')
+    index_options = f"--no-index --find-links {remote_wheelhouse_path} " if offline else ''
+    install_cmd = f"{remote_venv_path}/bin/pip install {index_options}-r {remote_req_path}"
+    logger.info("Installing Python dependencies on remote in virtual environment...")
+    if execute_ssh_command(ssh, install_cmd, working_dir=remote_path) != 0:
+      raise RuntimeError('Installing Python dependencies failed')
+
+    # Only a complete install is marked as reusable
+    execute_ssh_command(ssh, f"echo {venv_key} > {remote_venv_path}/{VENV_KEY_FILE}")
 
   # # Run main.py on the remote machine using the virtual environment
   # remote_main_path = posix_join(remote_path, 'main.py')
@@ -177,8 +202,8 @@ def main():
   # logger.info("Executing main.py on remote using virtual environment...")
   # execute_ssh_command(ssh, run_cmd, working_dir=remote_path)
 
-  # Close SCP/SSH
-  scp.close()
+  # Close SFTP/SSH
+  sftp.close()
   ssh.close()
   logger.info("Done.")
 
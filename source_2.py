@@ -5,9 +5,13 @@ import paramiko
 import shutil
 import zipfile
 from pathlib import Path
-from scp import SCPClient
 from posixpath import join as posix_join
 import argparse
+import tempfile
+
+from src.remote_stream import remote_compression, stream_tree_to_remote
+from src.sftp_transfer import upload_file_resumable
+from src.ssh import SshCommandRunner
 
 # Configuration
 hadoop_config_path = './config/hadoop_config.json'
@@ -40,6 +44,8 @@ logger.addHandler(console_handler)
 # Input handling 
 parser = argparse.ArgumentParser(description="Get year from input.")
 parser.add_argument("year", type=int, help="The year to process")
+parser.add_argument("--transfer", choices=["stream", "zip"], default="stream",
+                    help="stream: compressed tar piped into the container, zip: archive copied over SFTP")
 
 args = parser.parse_args()
 
@@ -84,23 +90,29 @@ def execute_ssh_command(ssh_client, command):
 
 # Step 1: Zip the files in the local source directory
 def zip_files(local_source_dir, zip_filename):
-    zip_file_path = os.path.join(local_source_dir, zip_filename)
+    # The archive is written outside the source directory, so the walk never picks it up
+    zip_file_path = os.path.join(tempfile.mkdtemp(), zip_filename)
     logger.info(f"Zipping files in {local_source_dir} to {zip_file_path}")
     with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
         for root, _, files in os.walk(local_source_dir):
             for file in files:
                 file_path = os.path.join(root, file)
+                if file == zip_filename:
+                    continue
                 zipf.write(file_path, os.path.relpath(file_path, local_source_dir))
     logger.info(f"Files zipped successfully: {zip_file_path}")
     return zip_file_path
 
 def copy_zip_to_remote(ssh_client, local_zip_path, remote_path="/tmp"):
-    
+    # Chunked parallel SFTP upload, a dropped connection resumes from the confirmed chunks
     remote_zip_path = posix_join(remote_path, os.path.basename(local_zip_path))
     logger.info(f"Copying {local_zip_path} to remote: {remote_zip_path}")
+
+    def reconnect():
+        ssh_client.connect(ssh_host, port=ssh_port, username=ssh_user, key_filename=private_key_path)
+
     try:
-        with SCPClient(ssh_client.get_transport()) as scp:
-            scp.put(local_zip_path, remote_zip_path)
+        upload_file_resumable(ssh_client, local_zip_path, remote_zip_path, logger, reconnect)
         logger.info("Zip file copied successfully.")
         return remote_zip_path
     except Exception as e:
@@ -115,6 +127,20 @@ def unzip_remote_into_container(ssh_client, remote_zip_path, container_name, sta
     logger.info(f"Unzipping {remote_zip_path} and copying to Docker container {container_name}")
     execute_ssh_command(ssh_client, unzip_command)
 
+def stream_files_into_container(ssh_client, local_source_dir, container_name, staging_dir_in_container):
+    # Compressed tar stream over the SSH channel, extracted straight into the container:
+    # no archive on either side and compression, transfer and extraction overlap
+    runner = SshCommandRunner(ssh_client.get_transport(), logger)
+    compression = remote_compression(runner)
+    extract_command = (
+        f'sudo docker exec -i {container_name} sh -c '
+        f'"rm -rf {staging_dir_in_container} && mkdir -p {staging_dir_in_container} && '
+        f'tar -xf - -C {staging_dir_in_container}"'
+    )
+    logger.info(f"Streaming files from {local_source_dir} into Docker container at {staging_dir_in_container}")
+    if not stream_tree_to_remote(runner, local_source_dir, extract_command, logger, compression):
+        raise Exception(f"Streaming {local_source_dir} into {container_name} failed")
+
 # Step 2: Create the target directory in HDFS
 def create_hdfs_directory(ssh_client, container_name, hdfs_target_dir):
     # Command to create target directory in HDFS using Docker
@@ -161,20 +187,25 @@ try:
     remote_upload_dir = f"/home/{ssh_user}/uploads"
     execute_ssh_command(ssh_client, f"mkdir -p {remote_upload_dir}")
 
-    # Step 1: Zip the files
-    zip_file_path = zip_files(local_source_dir, zip_filename)
+    # Step 1: Create target directory in HDFS
+    create_hdfs_directory(ssh_client, container_name, hdfs_target_dir)
 
-    # Step 2: Copy the zip file to the remote server
-    remote_zip_path = copy_zip_to_remote(ssh_client, zip_file_path, remote_upload_dir)
+    if args.transfer == "stream":
+        # Step 2: Stream the files into the Docker container
+        stream_files_into_container(ssh_client, local_source_dir, container_name, staging_dir_in_container)
+    else:
+        # Step 2: Zip the files
+        zip_file_path = zip_files(local_source_dir, zip_filename)
 
-    # Step 3: Unzip the file on the remote server
-    execute_ssh_command(ssh_client, f"unzip -o {remote_zip_path} -d {remote_upload_dir}/unzipped")
+        # Step 3: Copy the zip file to the remote server
+        remote_zip_path = copy_zip_to_remote(ssh_client, zip_file_path, remote_upload_dir)
+        shutil.rmtree(os.path.dirname(zip_file_path), ignore_errors=True)
 
-    # Step 4: Create target directory in HDFS
-    create_hdfs_directory(ssh_client, container_name, hdfs_target_dir)
+        # Step 4: Unzip the file on the remote server
+        execute_ssh_command(ssh_client, f"unzip -o {remote_zip_path} -d {remote_upload_dir}/unzipped")
 
-    # Step 5: Copy the unzipped files into the Docker container
-    copy_files_to_docker(ssh_client, f"{remote_upload_dir}/unzipped", container_name, staging_dir_in_container)
+        # Step 5: Copy the unzipped files into the Docker container
+        copy_files_to_docker(ssh_client, f"{remote_upload_dir}/unzipped", container_name, staging_dir_in_container)
 
     # Step 6: Upload to HDFS
     upload_to_hdfs(ssh_client, container_name, staging_dir_in_container, hdfs_target_dir)
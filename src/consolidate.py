@@ -0,0 +1,75 @@
+import datetime
+import os
+
+import numpy as np
+
+from src.openmeteo import DATA_PARAMS
+from src.utils import open_text_reader
+
+CONSOLIDATED_DIR = 'consolidated'
+
+def consolidate_open_meteo_year(year, manifest, base_output_dir, logger):
+  # Parses every station file of a year into one compressed columnar .npz:
+  #   time                 - shared hourly index (datetime64[m], local time)
+  #   station              - OriginalID per row of the variable arrays
+  #   latitude, longitude, elevation, utc_offset_seconds - station metadata from the preamble
+  #   <variable>           - float32 array (stations x hours) per DATA_PARAMS entry, NaN when missing
+  # np.load only reads the arrays that are accessed.
+  entries = manifest.completed_files(year)
+  if not entries:
+    logger.info(f"No weather files to consolidate for {year}")
+    return None
+
+  start = datetime.datetime(year, 1, 1)
+  hours = (datetime.datetime(year + 1, 1, 1) - start).days * 24
+  time_index = {
+    (start + datetime.timedelta(hours=hour)).strftime('%Y-%m-%dT%H:%M'): hour
+    for hour in range(hours)
+  }
+
+  values = {param: np.full((len(entries), hours), np.nan, dtype=np.float32) for param in DATA_PARAMS}
+  station_ids = []
+  metadata = {'latitude': [], 'longitude': [], 'elevation': [], 'utc_offset_seconds': []}
+
+  for station_index, entry in enumerate(entries):
+    station_ids.append(entry['station_id'])
+    with open_text_reader(entry['path']) as f:
+      metadata_header = next(f).rstrip('\n').split(',')
+      metadata_row = dict(zip(metadata_header, next(f).rstrip('\n').split(',')))
+      next(f)
+      # Data columns carry units, e.g. "temperature_2m (°C)"
+      data_header = [column.split(' ')[0] for column in next(f).rstrip('\n').split(',')]
+      columns = [(position, values[name]) for position, name in enumerate(data_header) if name in values]
+
+      for line in f:
+        fields = line.rstrip('\n').split(',')
+        hour = time_index.get(fields[0])
+        if hour is None:
+          continue
+        for position, array in columns:
+          if fields[position]:
+            array[station_index, hour] = float(fields[position])
+
+    for key in metadata:
+      metadata[key].append(float(metadata_row.get(key) or 'nan'))
+
+  output_dir = os.path.join(base_output_dir, CONSOLIDATED_DIR)
+  os.makedirs(output_dir, exist_ok=True)
+  path = os.path.join(output_dir, f"openmeteo_{year}.npz")
+  temp_path = path + '.part'
+  with open(temp_path, 'wb') as f:
+    np.savez_compressed(
+      f,
+      time=np.arange(np.datetime64(start, 'm'), np.datetime64(start, 'm') + hours * 60, 60),
+      station=np.array(station_ids),
+      latitude=np.array(metadata['latitude'], dtype=np.float32),
+      longitude=np.array(metadata['longitude'], dtype=np.float32),
+      elevation=np.array(metadata['elevation'], dtype=np.float32),
+      utc_offset_seconds=np.array(metadata['utc_offset_seconds'], dtype=np.int32),
+      **values
+    )
+  os.replace(temp_path, path)
+
+  logger.info(f"Consolidated {len(entries)} station files for {year} into {path} "
+              f"({os.path.getsize(path) / (1024 ** 2):.2f} MB)")
+  return path
@@ -11,18 +11,61 @@ def copy_files_to_docker_command(container_name, local_source_dir, staging_dir_i
 
   return copy_files_command
 
-def upload_to_hdfs_command(container_name, hdfs_target_dir, staging_dir_in_container):
+def copy_listed_files_to_docker_command(container_name, local_source_dir, filenames, staging_dir_in_container):
+  # Command to stream only the given files into a fresh staging directory of the container.
+  # Symlinks are followed, so a directory of links can stage files under other names.
+  copy_files_command = (
+    f"tar -C {local_source_dir} -chf - {' '.join(filenames)} | "
+    f'sudo docker exec -i {container_name} sh -c '
+    f'"rm -rf {staging_dir_in_container} && mkdir -p {staging_dir_in_container} && tar -xf - -C {staging_dir_in_container}"'
+  )
+
+  return copy_files_command
+
+def replication_option(replication_factor=None):
+  # Generic option making the write pipeline create every block with this many replicas
+  return f"-D dfs.replication={replication_factor} " if replication_factor else ''
+
+def stream_to_hdfs_command(container_name, hdfs_path, replication_factor=None):
+  # Command reading the file content from stdin - nothing is staged on disk
+  stream_command = (
+    f"sudo docker exec -i {container_name} hdfs dfs {replication_option(replication_factor)}-put -f - {hdfs_path}"
+  )
+
+  return stream_command
+
+def run_script_in_container_command(container_name):
+  # Command running a whole generated shell script, fed to its stdin, in one docker exec.
+  # Unlike sh -c, the script's size is not bound by the argument length limit.
+  return f"sudo docker exec -i {container_name} sh -s"
+
+def remove_staging_dir_command(container_name, staging_dir_in_container):
+  return f"sudo docker exec {container_name} rm -rf {staging_dir_in_container}"
+
+def upload_to_hdfs_command(container_name, hdfs_target_dir, staging_dir_in_container, replication_factor=None):
   # Command to upload files from Docker container to HDFS
-  upload_command = f'sudo docker exec {container_name} sh -c "hdfs dfs -put -f {staging_dir_in_container}/* {hdfs_target_dir}/"'
+  upload_command = (
+    f'sudo docker exec {container_name} sh -c '
+    f'"hdfs dfs {replication_option(replication_factor)}-put -f {staging_dir_in_container}/* {hdfs_target_dir}/"'
+  )
   
   return upload_command
   
-def set_replication_factor_command(container_name, hdfs_target_dir, replication_factor=3):
+def remove_hdfs_files_command(container_name, hdfs_paths):
+  remove_command = f"sudo docker exec {container_name} hdfs dfs -rm -f -skipTrash {' '.join(hdfs_paths)}"
+
+  return remove_command
+
+def set_replication_factor_command(container_name, hdfs_target_dir, replication_factor=3, wait=True):
+  wait_flag = '-w ' if wait else ''
   setrep_command = (
     f'sudo docker exec {container_name} sh -c '
-    f'"hdfs dfs -setrep -R -w {replication_factor} {hdfs_target_dir}"'
+    f'"hdfs dfs -setrep -R {wait_flag}{replication_factor} {hdfs_target_dir}"'
   )
   
   return setrep_command
 
-
+def fsck_command(container_name, hdfs_path):
+  # Summary of block health below the path, including under-replicated blocks.
+  # fsck exits non-zero for a missing path, the report is still wanted then.
+  return f'sudo docker exec {container_name} sh -c "hdfs fsck {hdfs_path} 2>&1 || true"'
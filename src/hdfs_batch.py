@@ -0,0 +1,183 @@
+import datetime
+import os
+import posixpath
+import shlex
+import shutil
+import tempfile
+import uuid
+
+from src.hadoop import copy_listed_files_to_docker_command, replication_option, run_script_in_container_command
+from src.utils import capture_local_command, run_local_command
+
+BATCH_MARKER = '@@hdfs-batch'
+# Paths of one hdfs dfs call, kept well below the kernel's limits on the length of a command's arguments
+MAX_GROUP_ARGUMENTS_LENGTH = 64 * 1024
+
+class HdfsCommandBatch:
+  # Collects mkdir/put/setrep/ls/rm operations of a pipeline step and runs them in a single
+  # docker exec. Consecutive operations of the same kind share one `hdfs dfs` call, and so
+  # one JVM: all mkdirs in one -mkdir -p, all puts with one -put of their common target root
+  # (split when their paths get too long for one command line).
+  # Local files for puts are staged in their layout below that root with one tar stream beforehand.
+  def __init__(self, container_name, logger, staging_root='/tmp/hdfs_batch'):
+    self.container_name = container_name
+    self.logger = logger
+    self.staging_dir = f"{staging_root}/{uuid.uuid4().hex}"
+    self.operations = []
+
+  def mkdir(self, path):
+    self.add('mkdir', path, ('mkdir',))
+
+  def put(self, local_path, hdfs_path, replication=None):
+    self.add('put', hdfs_path, ('put', replication), local_path=local_path)
+
+  def setrep(self, path, replication, wait=False):
+    self.add('setrep', path, ('setrep', replication, wait))
+
+  def ls(self, path, recursive=False):
+    self.add('ls', path, ('ls', recursive))
+
+  def rm(self, path):
+    self.add('rm', path, ('rm',))
+
+  def add(self, kind, path, key, **extra):
+    self.operations.append({'kind': kind, 'path': path, 'key': key, **extra})
+
+  def run(self):
+    # Returns one result per operation, in order: {kind, path, success, output} plus entries for ls
+    if not self.operations:
+      return []
+    groups = self.group_operations()
+
+    staged = True
+    puts = [operation for operation in self.operations if operation['kind'] == 'put']
+    if puts:
+      staged = self.stage_files(groups)
+
+    script_lines = []
+    for index, (key, operations) in enumerate(groups):
+      script_lines.append(f"echo '{BATCH_MARKER} begin {index}'")
+      script_lines.append(f"{self.group_command(index, key, operations)} 2>&1")
+      script_lines.append(f"echo \"{BATCH_MARKER} end {index} $?\"")
+    if puts:
+      script_lines.append(f"rm -rf {self.staging_dir}")
+    script_lines.append('exit 0')
+
+    output = None
+    if staged:
+      output = capture_local_command(run_script_in_container_command(self.container_name), self.logger,
+                                     input='\n'.join(script_lines).encode())
+    results = self.parse_results(groups, output or '')
+    self.operations = []
+    failed = sum(1 for result in results if not result['success'])
+    self.logger.info(f"HDFS batch: {len(results)} operations in {len(groups)} commands, {failed} failed")
+    return results
+
+  def group_operations(self):
+    groups = []
+    length = 0
+    for operation in self.operations:
+      length += len(operation['path']) + 1
+      if groups and groups[-1][0] == operation['key'] and length <= MAX_GROUP_ARGUMENTS_LENGTH:
+        groups[-1][1].append(operation)
+      else:
+        groups.append((operation['key'], [operation]))
+        length = len(operation['path']) + 1
+    return groups
+
+  def stage_files(self, groups):
+    # Every put group gets its own staging directory holding the targets relative to the
+    # group's root. A directory of symlinks mirrors that layout locally and is sent as one tar stream.
+    link_dir = tempfile.mkdtemp(prefix='hdfs_batch_')
+    try:
+      for index, (key, operations) in enumerate(groups):
+        if key[0] != 'put':
+          continue
+        root = put_root(operations)
+        for operation in operations:
+          link = os.path.join(link_dir, str(index), *posixpath.relpath(operation['path'], root).split('/'))
+          os.makedirs(os.path.dirname(link), exist_ok=True)
+          os.symlink(os.path.abspath(operation['local_path']), link)
+      command = copy_listed_files_to_docker_command(self.container_name, link_dir, ['.'], self.staging_dir)
+      return run_local_command(command, self.logger)
+    finally:
+      shutil.rmtree(link_dir, ignore_errors=True)
+
+  def group_command(self, index, key, operations):
+    paths = ' '.join(shlex.quote(operation['path']) for operation in operations)
+    if key[0] == 'mkdir':
+      return f"hdfs dfs -mkdir -p {paths}"
+    if key[0] == 'put':
+      # Staged directories are merged into the existing ones below the root
+      _, replication = key
+      root = put_root(operations)
+      entries = sorted({posixpath.relpath(operation['path'], root).split('/')[0] for operation in operations})
+      sources = ' '.join(f"{self.staging_dir}/{index}/{shlex.quote(entry)}" for entry in entries)
+      return f"hdfs dfs {replication_option(replication)}-put -f {sources} {shlex.quote(root.rstrip('/') + '/')}"
+    if key[0] == 'setrep':
+      _, replication, wait = key
+      return f"hdfs dfs -setrep -R {'-w ' if wait else ''}{replication} {paths}"
+    if key[0] == 'ls':
+      return f"hdfs dfs -ls {'-R ' if key[1] else ''}{paths}"
+    if key[0] == 'rm':
+      return f"hdfs dfs -rm -r -f -skipTrash {paths}"
+    raise ValueError(f"Unknown HDFS batch operation: {key[0]}")
+
+  def parse_results(self, groups, output):
+    outputs, statuses = {}, {}
+    current = None
+    for line in output.splitlines():
+      if line.startswith(f"{BATCH_MARKER} begin "):
+        current = int(line.split()[2])
+        outputs[current] = []
+      elif line.startswith(f"{BATCH_MARKER} end "):
+        _, _, index, status = line.split()
+        statuses[int(index)] = int(status)
+        current = None
+      elif current is not None:
+        outputs[current].append(line)
+
+    results = []
+    for index, (key, operations) in enumerate(groups):
+      lines = outputs.get(index, [])
+      status = statuses.get(index)
+      # hdfs dfs reports a failing path as "<command>: `<path>': <reason>" and carries on with the rest
+      error_lines = [line for line in lines if line.startswith(f"{key[0]}: ")]
+      failed_paths = {operation['path'] for operation in operations
+                      if any(f"`{operation['path']}'" in line for line in error_lines)}
+      for operation in operations:
+        if status is None:
+          success = False
+        elif status == 0:
+          success = True
+        else:
+          # An error naming none of the targets (e.g. a staged source) fails the whole group
+          success = bool(failed_paths) and operation['path'] not in failed_paths
+        result = {'kind': operation['kind'], 'path': operation['path'], 'success': success,
+                  'output': [line for line in lines if operation['path'] in line]}
+        if operation['kind'] == 'ls':
+          result['entries'] = [entry for entry in parse_ls_output('\n'.join(lines))
+                               if entry['path'] == operation['path']
+                               or entry['path'].startswith(operation['path'].rstrip('/') + '/')]
+        results.append(result)
+    return results
+
+def put_root(operations):
+  # Deepest directory containing every target, it exists when the targets' directories do
+  return posixpath.commonpath([posixpath.dirname(operation['path']) for operation in operations])
+
+def parse_ls_output(output):
+  # Lines of `hdfs dfs -ls`: permissions replication owner group size date time path
+  entries = []
+  for line in output.splitlines():
+    fields = line.split(None, 7)
+    if len(fields) < 8 or line.startswith('Found '):
+      continue
+    modification_time = datetime.datetime.strptime(f"{fields[5]} {fields[6]}", '%Y-%m-%d %H:%M').timestamp()
+    entries.append({
+      'path': fields[7],
+      'type': 'directory' if fields[0].startswith('d') else 'file',
+      'size': int(fields[4]),
+      'modification_time': modification_time
+    })
+  return entries
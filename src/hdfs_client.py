@@ -0,0 +1,296 @@
+import abc
+import os
+import posixpath
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src.hadoop import (create_hdfs_directory_command, fsck_command, remove_hdfs_files_command,
+                        set_replication_factor_command)
+from src.hdfs_batch import HdfsCommandBatch, parse_ls_output
+from src.hdfs_stream import read_chunks, stream_to_hdfs
+from src.http_client import create_session
+from src.utils import capture_local_command, file_sha256, run_local_command
+
+# Files from this size on are streamed through the container's stdin instead of staged in a batch
+STREAM_SIZE_THRESHOLD = 16 * 1024 * 1024
+
+class HdfsClient(abc.ABC):
+  # Common interface of the HDFS backends. Paths are absolute HDFS paths,
+  # list() returns dicts with path, type ('file' or 'directory'), size and modification_time.
+  # A backend missing one of the abstract methods fails when it is created.
+  @abc.abstractmethod
+  def mkdir(self, path):
+    raise NotImplementedError
+
+  def mkdirs(self, paths):
+    return all([self.mkdir(path) for path in paths])
+
+  @abc.abstractmethod
+  def put(self, local_path, hdfs_path, replication=None):
+    raise NotImplementedError
+
+  def put_many(self, transfers, replication=None):
+    # transfers: (local_path, hdfs_path) pairs. Returns {hdfs_path: success}.
+    return {hdfs_path: self.put(local_path, hdfs_path, replication) for local_path, hdfs_path in transfers}
+
+  @abc.abstractmethod
+  def list(self, path, recursive=False):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def checksum(self, path):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def setrep(self, path, replication, wait=False):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def under_replicated(self, path):
+    # (under-replicated blocks, total blocks) below the path, None when unknown
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def delete(self, paths):
+    raise NotImplementedError
+
+class DockerCliHdfsClient(HdfsClient):
+  # The original backend: hdfs dfs inside the master container through docker exec
+  def __init__(self, container_name, logger):
+    self.container_name = container_name
+    self.logger = logger
+
+  def mkdir(self, path):
+    return run_local_command(create_hdfs_directory_command(self.container_name, path), self.logger)
+
+  def mkdirs(self, paths):
+    batch = HdfsCommandBatch(self.container_name, self.logger)
+    for path in paths:
+      batch.mkdir(path)
+    return all(result['success'] for result in batch.run())
+
+  def put(self, local_path, hdfs_path, replication=None):
+    with open(local_path, 'rb') as f:
+      return stream_to_hdfs(self.container_name, hdfs_path, read_chunks(f), self.logger, replication)
+
+  def put_many(self, transfers, replication=None):
+    # Large files are streamed one by one, nothing is copied inside the container.
+    # Smaller ones are staged together and put by one JVM, unless only one of them is left.
+    large = [transfer for transfer in transfers if os.path.getsize(transfer[0]) >= STREAM_SIZE_THRESHOLD]
+    small = [transfer for transfer in transfers if os.path.getsize(transfer[0]) < STREAM_SIZE_THRESHOLD]
+    if len(small) <= 1:
+      return super().put_many(transfers, replication)
+    results = super().put_many(large, replication)
+    batch = HdfsCommandBatch(self.container_name, self.logger)
+    for local_path, hdfs_path in small:
+      batch.put(local_path, hdfs_path, replication)
+    results.update({result['path']: result['success'] for result in batch.run()})
+    return results
+
+  def list(self, path, recursive=False):
+    flags = '-R ' if recursive else ''
+    output = capture_local_command(f"sudo docker exec {self.container_name} hdfs dfs -ls {flags}{path}", self.logger)
+    return parse_ls_output(output or '')
+
+  def checksum(self, path):
+    output = capture_local_command(f"sudo docker exec {self.container_name} hdfs dfs -checksum {path}", self.logger)
+    if not output:
+      return None
+    # <path>\t<algorithm>\t<checksum>
+    fields = output.strip().split('\t')
+    return f"{fields[1]}:{fields[2]}" if len(fields) >= 3 else None
+
+  def setrep(self, path, replication, wait=False):
+    command = set_replication_factor_command(self.container_name, path, replication, wait)
+    return run_local_command(command, self.logger)
+
+  def under_replicated(self, path):
+    return parse_fsck_output(capture_local_command(fsck_command(self.container_name, path), self.logger) or '')
+
+  def delete(self, paths):
+    return run_local_command(remove_hdfs_files_command(self.container_name, paths), self.logger)
+
+class WebHdfsClient(HdfsClient):
+  # REST client against the NameNode's WebHDFS endpoint (e.g. http://localhost:9870).
+  # One pooled session serves all calls and put_many uploads files in parallel.
+  def __init__(self, namenode_url, user, logger, max_workers=8):
+    self.namenode_url = namenode_url.rstrip('/')
+    self.base_url = self.namenode_url + '/webhdfs/v1'
+    self.user = user
+    self.logger = logger
+    self.max_workers = max_workers
+    self.session = create_session(max_connections_per_host=max_workers, max_hosts=16)
+
+  def request(self, method, path, op, **params):
+    params = {'op': op, 'user.name': self.user, **params}
+    return self.session.request(method, self.base_url + path, params=params)
+
+  def mkdir(self, path):
+    response = self.request('PUT', path, 'MKDIRS')
+    return response.ok and response.json().get('boolean', False)
+
+  def put(self, local_path, hdfs_path, replication=None):
+    # Two steps: the NameNode answers CREATE with a redirect to the DataNode that takes the data
+    params = {'overwrite': 'true'}
+    if replication:
+      params['replication'] = replication
+    response = self.session.put(self.base_url + hdfs_path, allow_redirects=False,
+                                params={'op': 'CREATE', 'user.name': self.user, **params})
+    if response.status_code != 307:
+      self.logger.error(f"WebHDFS CREATE {hdfs_path} failed: {response.status_code} {response.text}")
+      return False
+    with open(local_path, 'rb') as f:
+      response = self.session.put(response.headers['Location'], data=f,
+                                  headers={'Content-Type': 'application/octet-stream'})
+    if response.status_code != 201:
+      self.logger.error(f"WebHDFS upload of {hdfs_path} failed: {response.status_code} {response.text}")
+      return False
+    return True
+
+  def put_many(self, transfers, replication=None):
+    results = {}
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      futures = {executor.submit(self.put, local_path, hdfs_path, replication): hdfs_path
+                 for local_path, hdfs_path in transfers}
+      for future in as_completed(futures):
+        try:
+          results[futures[future]] = future.result()
+        except Exception as e:
+          self.logger.error(f"WebHDFS upload of {futures[future]} failed: {e}")
+          results[futures[future]] = False
+    return results
+
+  def list(self, path, recursive=False):
+    response = self.request('GET', path, 'LISTSTATUS')
+    if response.status_code == 404:
+      return []
+    response.raise_for_status()
+    entries = []
+    for status in response.json()['FileStatuses']['FileStatus']:
+      # A file path lists itself with an empty suffix
+      entry_path = posixpath.join(path, status['pathSuffix']) if status['pathSuffix'] else path
+      entry = {
+        'path': entry_path,
+        'type': 'directory' if status['type'] == 'DIRECTORY' else 'file',
+        'size': status['length'],
+        'modification_time': status['modificationTime'] / 1000
+      }
+      entries.append(entry)
+      if recursive and entry['type'] == 'directory':
+        entries.extend(self.list(entry_path, recursive=True))
+    return entries
+
+  def checksum(self, path):
+    response = self.request('GET', path, 'GETFILECHECKSUM')
+    if not response.ok:
+      return None
+    checksum = response.json()['FileChecksum']
+    return f"{checksum['algorithm']}:{checksum['bytes']}"
+
+  def setrep(self, path, replication, wait=False):
+    # WebHDFS sets replication per file, directories are walked
+    status = self.request('GET', path, 'GETFILESTATUS')
+    if not status.ok:
+      return False
+    targets = [path]
+    if status.json()['FileStatus']['type'] == 'DIRECTORY':
+      targets = [entry['path'] for entry in self.list(path, recursive=True) if entry['type'] == 'file']
+    return all(self.request('PUT', target, 'SETREPLICATION', replication=replication).ok for target in targets)
+
+  def under_replicated(self, path):
+    # WebHDFS has no fsck operation, the NameNode serves the same report over HTTP
+    response = self.session.get(self.namenode_url + '/fsck', params={'ugi': self.user, 'path': path})
+    return parse_fsck_output(response.text) if response.ok else None
+
+  def delete(self, paths):
+    return all(self.request('DELETE', path, 'DELETE', recursive='true').ok for path in paths)
+
+class LocalHdfsClient(HdfsClient):
+  # Stand-in backed by a local directory, for tests and dry runs.
+  # Checksums are sha256 of the content, not HDFS's MD5-of-CRC.
+  def __init__(self, root_dir, logger=None):
+    self.root_dir = root_dir
+    self.logger = logger
+    self.replication = {}
+
+  def local_path(self, hdfs_path):
+    return os.path.join(self.root_dir, hdfs_path.lstrip('/'))
+
+  def mkdir(self, path):
+    os.makedirs(self.local_path(path), exist_ok=True)
+    return True
+
+  def put(self, local_path, hdfs_path, replication=None):
+    target = self.local_path(hdfs_path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copyfile(local_path, target)
+    if replication:
+      self.replication[hdfs_path] = replication
+    return True
+
+  def list(self, path, recursive=False):
+    root = self.local_path(path)
+    if not os.path.exists(root):
+      return []
+    if os.path.isfile(root):
+      return [self.entry(path)]
+    entries = []
+    for name in sorted(os.listdir(root)):
+      entry = self.entry(posixpath.join(path, name))
+      entries.append(entry)
+      if recursive and entry['type'] == 'directory':
+        entries.extend(self.list(entry['path'], recursive=True))
+    return entries
+
+  def entry(self, hdfs_path):
+    local = self.local_path(hdfs_path)
+    return {
+      'path': hdfs_path,
+      'type': 'directory' if os.path.isdir(local) else 'file',
+      'size': 0 if os.path.isdir(local) else os.path.getsize(local),
+      'modification_time': os.path.getmtime(local)
+    }
+
+  def checksum(self, path):
+    return f"SHA256:{file_sha256(self.local_path(path))}"
+
+  def setrep(self, path, replication, wait=False):
+    for entry in [self.entry(path)] + self.list(path, recursive=True):
+      if entry['type'] == 'file':
+        self.replication[entry['path']] = replication
+    return True
+
+  def under_replicated(self, path):
+    # A local directory has nothing to re-replicate
+    return 0, sum(1 for entry in self.list(path, recursive=True) if entry['type'] == 'file')
+
+  def delete(self, paths):
+    for path in paths:
+      local = self.local_path(path)
+      if os.path.isdir(local):
+        shutil.rmtree(local)
+      elif os.path.exists(local):
+        os.remove(local)
+    return True
+
+def parse_fsck_output(output):
+  # Summary lines of `hdfs fsck`: " Total blocks (validated):\t12 (...)" and " Under-replicated blocks:\t3 (25.0 %)"
+  # A path that does not exist has no blocks to replicate
+  if re.search(r'Path .* does not exist', output):
+    return 0, 0
+  total = re.search(r'Total blocks \(validated\):\s+(\d+)', output)
+  under = re.search(r'Under-replicated blocks:\s+(\d+)', output)
+  if not total or not under:
+    return None
+  return int(under.group(1)), int(total.group(1))
+
+def create_hdfs_client(backend, logger, container_name=None, namenode_url=None, user=None, root_dir=None,
+                       max_workers=8):
+  if backend == 'docker':
+    return DockerCliHdfsClient(container_name, logger)
+  if backend == 'webhdfs':
+    return WebHdfsClient(namenode_url, user, logger, max_workers)
+  if backend == 'local':
+    return LocalHdfsClient(root_dir, logger)
+  raise ValueError(f"Unknown HDFS backend: {backend}")
@@ -0,0 +1,13 @@
+from src.hadoop import stream_to_hdfs_command
+from src.utils import run_local_command_with_input
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def stream_to_hdfs(container_name, hdfs_path, chunks, logger, replication_factor=None):
+  # Pipes any iterable of byte chunks (an open file, a zip member, an HTTP response's
+  # iter_content) straight into HDFS through the container's stdin
+  command = stream_to_hdfs_command(container_name, hdfs_path, replication_factor)
+  return run_local_command_with_input(command, chunks, logger)
+
+def read_chunks(f, chunk_size=STREAM_CHUNK_SIZE):
+  return iter(lambda: f.read(chunk_size), b'')
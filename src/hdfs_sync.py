@@ -0,0 +1,106 @@
+import json
+import os
+import posixpath
+import re
+
+from src.utils import file_sha256
+
+def sync_to_hdfs(hdfs, local_dir, hdfs_target_dir, cache_dir, logger, files=None, delete_orphans=False,
+                 refresh_remote=False, report_path=None, replication=None):
+  # Uploads only local files that are new or changed compared to HDFS.
+  # The remote listing is cached together with the sha256 of every uploaded file,
+  # so an unchanged tree costs no HDFS calls at all. refresh_remote re-lists HDFS first.
+  # files limits the sync to these paths relative to local_dir, replication is applied at write time.
+  cache_path = os.path.join(cache_dir, f"{re.sub(r'[^A-Za-z0-9]+', '_', hdfs_target_dir).strip('_')}.json")
+  remote = load_remote_listing(cache_path)
+  if remote is None or refresh_remote:
+    remote = list_remote_files(hdfs, hdfs_target_dir, remote or {})
+
+  local = list_local_files(local_dir, files)
+
+  report = {'added': [], 'modified': [], 'deleted': [], 'unchanged': 0}
+  transfers = []
+  for relative_path, stat in sorted(local.items()):
+    cached = remote.get(relative_path)
+    if cached is None:
+      report['added'].append(relative_path)
+    elif cached['size'] != stat['size'] or (cached.get('mtime') != stat['mtime']
+                                           and cached.get('sha256') != file_sha256(stat['path'])):
+      report['modified'].append(relative_path)
+    else:
+      report['unchanged'] += 1
+      continue
+    transfers.append((relative_path, stat))
+
+  hdfs.mkdirs(sorted({posixpath.dirname(posixpath.join(hdfs_target_dir, path)) for path, _ in transfers}))
+  results = hdfs.put_many([(stat['path'], posixpath.join(hdfs_target_dir, path)) for path, stat in transfers],
+                          replication)
+
+  failed = []
+  for relative_path, stat in transfers:
+    if results.get(posixpath.join(hdfs_target_dir, relative_path)):
+      remote[relative_path] = {'size': stat['size'], 'mtime': stat['mtime'], 'sha256': file_sha256(stat['path'])}
+    else:
+      failed.append(relative_path)
+
+  if delete_orphans:
+    # Only files under the synced scope can be orphans
+    orphans = sorted(path for path in remote if path not in local and (files is None or path in files))
+    if orphans and hdfs.delete([posixpath.join(hdfs_target_dir, path) for path in orphans]):
+      for path in orphans:
+        del remote[path]
+      report['deleted'] = orphans
+
+  save_remote_listing(cache_path, remote)
+  report['failed'] = failed
+
+  logger.info(f"Sync {local_dir} -> {hdfs_target_dir}: {len(report['added'])} added, "
+              f"{len(report['modified'])} modified, {len(report['deleted'])} deleted, "
+              f"{report['unchanged']} unchanged, {len(failed)} failed")
+  if report_path:
+    with open(report_path, 'w', encoding='utf-8') as f:
+      json.dump(report, f, indent=2)
+  return report
+
+def list_local_files(local_dir, files=None):
+  # Hidden files and directories (.partial, .cache, markers) are never synced
+  local = {}
+  if files is None:
+    files = []
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+      dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+      for filename in filenames:
+        if not filename.startswith('.') and not filename.endswith('.part'):
+          files.append(os.path.relpath(os.path.join(dirpath, filename), local_dir).replace(os.sep, '/'))
+  for relative_path in files:
+    path = os.path.join(local_dir, relative_path)
+    if os.path.isfile(path):
+      stat = os.stat(path)
+      local[relative_path] = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+  return local
+
+def list_remote_files(hdfs, hdfs_target_dir, cached):
+  # Fresh listing, keeping cached hashes of files whose size did not change
+  remote = {}
+  prefix = hdfs_target_dir.rstrip('/') + '/'
+  for entry in hdfs.list(hdfs_target_dir, recursive=True):
+    if entry['type'] != 'file' or not entry['path'].startswith(prefix):
+      continue
+    relative_path = entry['path'][len(prefix):]
+    previous = cached.get(relative_path, {})
+    remote[relative_path] = {'size': entry['size']}
+    if previous.get('size') == entry['size']:
+      remote[relative_path].update({key: previous[key] for key in ('mtime', 'sha256') if key in previous})
+  return remote
+
+def load_remote_listing(cache_path):
+  if not os.path.exists(cache_path):
+    return None
+  with open(cache_path, 'r', encoding='utf-8') as f:
+    return json.load(f)
+
+def save_remote_listing(cache_path, remote):
+  os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+  with open(cache_path + '.part', 'w', encoding='utf-8') as f:
+    json.dump(remote, f)
+  os.replace(cache_path + '.part', cache_path)
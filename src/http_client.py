@@ -0,0 +1,36 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 60)
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+  # Applies a default timeout to every request sent through the session
+  def __init__(self, timeout=DEFAULT_TIMEOUT, **kwargs):
+    self.timeout = timeout
+    super().__init__(**kwargs)
+
+  def send(self, request, **kwargs):
+    if kwargs.get('timeout') is None:
+      kwargs['timeout'] = self.timeout
+    return super().send(request, **kwargs)
+
+def create_session(max_connections_per_host=8, max_hosts=4, timeout=DEFAULT_TIMEOUT):
+  # Pooled keep-alive session shared by all API fetchers.
+  # pool_block caps open connections per host at max_connections_per_host,
+  # extra threads wait for a free connection instead of opening new ones.
+  session = requests.Session()
+  adapter = TimeoutHTTPAdapter(
+    timeout=timeout,
+    pool_connections=max_hosts,
+    pool_maxsize=max_connections_per_host,
+    pool_block=True,
+    max_retries=0
+  )
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+
+  # gzip/deflate always, br when the brotli package is installed
+  session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+  return session
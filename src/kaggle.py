@@ -1,16 +1,153 @@
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from kaggle.api.kaggle_api_extended import KaggleApi
+import requests
 import time
 import zipfile
 import shutil
 
+from src.http_client import create_session
+
 s1_source = 'wisekinder/poland-air-quality-monitoring-dataset-2017-2023'
 
 download_dir = os.path.expanduser('data')
 output_dir_s1 = os.path.expanduser('source1')
 
+EXTRACTION_STATE_FILE = '.extracted.json'
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+KAGGLE_FILE_DOWNLOAD_URL = "https://www.kaggle.com/api/v1/datasets/download/{dataset}/{file}"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# dataset_version() when the API does not tell - a partial download of it cannot be trusted
+UNKNOWN_VERSION = 'unknown'
+
+
+def download_selected_files_from_kaggle(source_url, files, temp_dir, dest_dir, logger, max_workers=4,
+                                        max_retries=3):
+    # Fetches only the listed files, concurrently and resumably. Files that cannot be
+    # fetched one by one fall back to the full archive download.
+    logger.info(f"Start downloading {len(files)} selected files from: https://www.kaggle.com/datasets/{source_url}")
+
+    api = KaggleApi()
+    api.authenticate()
+    logger.info("Authentication in Kaggle API successful.")
+
+    version = dataset_version(api, source_url, logger)
+    auth = (api.config_values.get(api.CONFIG_NAME_USER), api.config_values.get(api.CONFIG_NAME_KEY))
+    session = create_session(max_connections_per_host=max_workers)
+    session.auth = auth
+
+    extraction_state = load_extraction_state(dest_dir)
+    to_download = []
+    for file in files:
+        target_path = os.path.join(dest_dir, file)
+        previous = extraction_state.get(file)
+        if previous and previous.get('version') == version and os.path.exists(target_path) \
+                and os.path.getsize(target_path) == previous['size']:
+            logger.info(f" - Up to date: '{file}'")
+            continue
+        to_download.append(file)
+
+    start_time = time.time()
+    failed_files = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_kaggle_file, session, source_url, file, dest_dir, version,
+                                   max_retries, logger): file
+                   for file in to_download}
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                size = future.result()
+                extraction_state[file] = {"version": version, "size": size}
+                logger.info(f" - Downloaded: '{file}' ({size / (1024 ** 2):.2f} MB)")
+            except Exception as e:
+                logger.warning(f" - Per-file download of '{file}' failed: {e}")
+                failed_files.append(file)
+
+    save_extraction_state(dest_dir, extraction_state)
+    elapsed_time = time.time() - start_time
+    logger.info(f"Per-file download finished in {elapsed_time:.2f} s, "
+                f"{len(to_download) - len(failed_files)}/{len(to_download)} files fetched.")
+
+    if failed_files:
+        logger.warning(f"Falling back to the full archive for {len(failed_files)} files.")
+        download_files_from_kaggle(source_url, failed_files, temp_dir, dest_dir, logger)
+
+
+def download_kaggle_file(session, source_url, file, dest_dir, version, max_retries, logger):
+    # Resumes from the bytes already in the .part file with a Range request. The .part file
+    # belongs to one dataset version, partial downloads of other versions (or of an unknown
+    # version) are thrown away.
+    target_path = os.path.join(dest_dir, file)
+    temp_path = f"{target_path}.{version}.part"
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    remove_stale_partial_downloads(target_path, None if version == UNKNOWN_VERSION else temp_path)
+    url = KAGGLE_FILE_DOWNLOAD_URL.format(dataset=source_url, file=file)
+
+    expected_size = None
+    for attempt in range(1, max_retries + 1):
+        offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True) as response:
+                expected_size = total_size_from_headers(response) or expected_size
+                if response.status_code == 416:
+                    # Nothing left to fetch, the previous run got the whole file
+                    break
+                response.raise_for_status()
+                mode = 'ab' if offset and response.status_code == 206 else 'wb'
+                with open(temp_path, mode) as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            break
+        except requests.HTTPError:
+            raise
+        except requests.RequestException as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f" - Download of '{file}' interrupted ({attempt}/{max_retries}), resuming: {e}")
+            time.sleep(2 ** attempt)
+
+    downloaded_size = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+    if expected_size is not None and downloaded_size != expected_size:
+        # Not resumable from here, the next attempt starts over
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise ValueError(f"'{file}' has {downloaded_size} bytes, expected {expected_size}")
+
+    # Larger files are served zipped
+    if zipfile.is_zipfile(temp_path) and not file.endswith('.zip'):
+        with zipfile.ZipFile(temp_path, 'r') as zip_ref:
+            member = zip_ref.namelist()[0]
+            with zip_ref.open(member) as source, open(target_path + '.unzipped', 'wb') as target:
+                shutil.copyfileobj(source, target, EXTRACT_CHUNK_SIZE)
+        os.replace(target_path + '.unzipped', target_path)
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, target_path)
+    return os.path.getsize(target_path)
+
+
+def total_size_from_headers(response):
+    # Full size of the file: "Content-Range: bytes 100-199/200" (also "bytes */200" on 416),
+    # or Content-Length of a complete response
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    if response.status_code == 200 and response.headers.get('Content-Length'):
+        return int(response.headers['Content-Length'])
+    return None
+
+
+def remove_stale_partial_downloads(target_path, temp_path):
+    directory, name = os.path.split(target_path)
+    for entry in os.listdir(directory):
+        path = os.path.join(directory, entry)
+        if entry.startswith(name + '.') and entry.endswith('.part') and path != temp_path:
+            os.remove(path)
 
-def download_files_from_kaggle(source_url, files, temp_dir, dest_dir, logger):
+
+def download_files_from_kaggle(source_url, files, temp_dir, dest_dir, logger, max_workers=None):
     zip_file_name = None
     zip_file_path = None
     extracted_files_info = []
@@ -22,87 +159,119 @@ def download_files_from_kaggle(source_url, files, temp_dir, dest_dir, logger):
         api.authenticate()
         logger.info("Authentication in Kaggle API successful.")
 
+        # Archives are cached per dataset version, an unchanged dataset is never downloaded again
+        version = dataset_version(api, source_url, logger)
+        cache_dir = os.path.join(temp_dir, *source_url.split('/'), version)
+
         try:
-            if not os.path.isdir(temp_dir):
-                os.makedirs(temp_dir)
-                logger.info(f"Output directory: '{temp_dir}' created.")
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+                logger.info(f"Output directory: '{cache_dir}' created.")
             else:
-                logger.info(f"Output directory: '{temp_dir}' exists.")
+                logger.info(f"Output directory: '{cache_dir}' exists.")
         except OSError as e:
-            logger.error(f"Cannot make output directory '{temp_dir}': {e}")
+            logger.error(f"Cannot make output directory '{cache_dir}': {e}")
 
-        logger.info(f"Started downloading files to: '{temp_dir}'.")
-        start_time = time.time()
-        file_size = -1
+        zip_file_path = find_cached_archive(cache_dir)
+        if zip_file_path:
+            zip_file_name = os.path.basename(zip_file_path)
+            logger.info(f"Dataset version '{version}' found in cache: '{zip_file_name}' - skipping download.")
+        else:
+            logger.info(f"Started downloading files to: '{cache_dir}'.")
+            start_time = time.time()
+            file_size = -1
 
-        try:
-            api.dataset_download_files(source_url, path=temp_dir, quiet=True)
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            zip_file_name = os.listdir(temp_dir)[0]
-            zip_file_path = os.path.join(temp_dir, zip_file_name)
-            file_size = os.path.getsize(zip_file_path) / (1024 ** 2)
+            try:
+                api.dataset_download_files(source_url, path=cache_dir, quiet=True)
+                end_time = time.time()
+                elapsed_time = end_time - start_time
+                zip_file_path = find_cached_archive(cache_dir)
+                zip_file_name = os.path.basename(zip_file_path)
+                file_size = os.path.getsize(zip_file_path) / (1024 ** 2)
 
-            logger.info("Data downloaded.")
-            logger.info("Status: SUCCESS")
-            logger.info(f"Download time: {elapsed_time:.2f} s")
-            logger.info(f"Size: {file_size:.2f} MB")
-            logger.info(f"Saved as: {zip_file_name}")
+                logger.info("Data downloaded.")
+                logger.info("Status: SUCCESS")
+                logger.info(f"Download time: {elapsed_time:.2f} s")
+                logger.info(f"Size: {file_size:.2f} MB")
+                logger.info(f"Saved as: {zip_file_name}")
 
-        except Exception as e:
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            logger.error("Error while downloading.")
-            logger.error("Status: ERROR")
-            logger.error(f"Time till error: {elapsed_time:.2f} s")
-            logger.error(f"Info: {e}")
+                remove_stale_versions(os.path.dirname(cache_dir), version, logger)
+
+            except Exception as e:
+                end_time = time.time()
+                elapsed_time = end_time - start_time
+                logger.error("Error while downloading.")
+                logger.error("Status: ERROR")
+                logger.error(f"Time till error: {elapsed_time:.2f} s")
+                logger.error(f"Info: {e}")
 
         logger.info(f"Started extracting chosen files from: '{zip_file_name}' "
                     f"to: '{dest_dir}'.")
         start_time = time.time()
         extraction_successful_count = 0
         extraction_failed_count = 0
+        extraction_skipped_count = 0
 
         try:
             with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-                archive_file_list = zip_ref.namelist()
-
-                for file in files:
-                    if file in archive_file_list:
-                        try:
-                            member_info = zip_ref.getinfo(file)
-                            target_path = os.path.join(dest_dir, file)
-
-                            os.makedirs(os.path.dirname(target_path), exist_ok=True)
-
-                            with zip_ref.open(member_info) as source, open(target_path, "wb") as target:
-                                shutil.copyfileobj(source, target)
-
-                            logger.info(f" - Extracted and saved: '{file}'")
-                            file_size = os.path.getsize(target_path)
-                            extracted_files_info.append(
-                                {"name": file, "path": target_path, "size": file_size})
-                            extraction_successful_count += 1
-
-                        except Exception as extract_err:
-                            logger.error(f" - Error while extracting file: '{file}': {extract_err}")
-                            extraction_failed_count += 1
-                    else:
-                        logger.warning(
-                            f" - File: '{file}' does not exist in: '{zip_file_path}' - skipping.")
+                archive_members = {info.filename: info for info in zip_ref.infolist()}
+
+            # Members whose CRC and size match the previous extraction are left alone
+            extraction_state = load_extraction_state(dest_dir)
+            to_extract = []
+            for file in files:
+                if file not in archive_members:
+                    logger.warning(
+                        f" - File: '{file}' does not exist in: '{zip_file_path}' - skipping.")
+                    extraction_failed_count += 1
+                    continue
+
+                member_info = archive_members[file]
+                target_path = os.path.join(dest_dir, file)
+                previous = extraction_state.get(file)
+                if previous and previous.get('crc') == member_info.CRC and os.path.exists(target_path) \
+                        and os.path.getsize(target_path) == member_info.file_size:
+                    logger.info(f" - Up to date: '{file}'")
+                    extracted_files_info.append(
+                        {"name": file, "path": target_path, "size": member_info.file_size})
+                    extraction_skipped_count += 1
+                    continue
+                to_extract.append(file)
+
+            # Each member is inflated in its own process, deflate is CPU bound
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(extract_member, zip_file_path, file, dest_dir): file
+                           for file in to_extract}
+                for future in as_completed(futures):
+                    file = futures[future]
+                    try:
+                        item = future.result()
+                        logger.info(f" - Extracted and saved: '{file}'")
+                        extracted_files_info.append(item)
+                        extraction_state[file] = {"crc": item["crc"], "size": item["size"], "version": version}
+                        extraction_successful_count += 1
+
+                    except Exception as extract_err:
+                        logger.error(f" - Error while extracting file: '{file}': {extract_err}")
                         extraction_failed_count += 1
 
+            save_extraction_state(dest_dir, extraction_state)
+
             end_time = time.time()
             elapsed_time = end_time - start_time
             logger.info(f"Extraction finished in {elapsed_time:.2f} s.")
             final_status = "SUCCESS" if extraction_failed_count == 0 else "FAILURE"
             logger.info(f"Final status of extraction: {final_status}")
             logger.info(f"Successfully extracted {extraction_successful_count} files.")
+            if extraction_skipped_count > 0:
+                logger.info(f"Skipped {extraction_skipped_count} up to date files.")
             if extraction_failed_count > 0:
                 logger.warning(f"Failed to extract {extraction_failed_count} files.")
 
         except zipfile.BadZipFile:
             logger.error(f"File: '{zip_file_path}' is not a vaild ZIP file.")
+            # A corrupt archive must not be served from the cache again
+            os.remove(zip_file_path)
             raise
 
         except Exception as e:
@@ -122,13 +291,68 @@ def download_files_from_kaggle(source_url, files, temp_dir, dest_dir, logger):
             logger.error("Cannot extract and save chosen files.")
 
     finally:
-        if zip_file_path and os.path.exists(zip_file_path):
-            try:
-                logger.info("Cleaning up.")
-                os.remove(zip_file_path)
-                if not os.listdir(temp_dir):
-                    os.rmdir(temp_dir)
-            except Exception as cleanup_err:
-                logger.warning("Cleaning up failed. No permission for deleting files and directories.")
-
         logger.info("Downloading data from Kaggle finished successfully.")
+
+
+def dataset_version(api, source_url, logger):
+    # Current version number of the dataset, falls back to its last update time
+    owner, name = source_url.split('/')
+    try:
+        for dataset in api.dataset_list(search=name, user=owner):
+            if str(getattr(dataset, 'ref', '')) != source_url:
+                continue
+            for attribute in ('currentVersionNumber', 'current_version_number'):
+                version = getattr(dataset, attribute, None)
+                if version:
+                    return f"v{version}"
+            last_updated = getattr(dataset, 'lastUpdated', None) or getattr(dataset, 'last_updated', None)
+            if last_updated:
+                return f"updated_{str(last_updated).replace(':', '').replace(' ', '_')}"
+    except Exception as e:
+        logger.warning(f"Cannot read dataset version: {e}")
+    logger.warning("Dataset version unknown - the cached archive will be reused.")
+    return UNKNOWN_VERSION
+
+
+def find_cached_archive(cache_dir):
+    archives = sorted(file for file in os.listdir(cache_dir) if file.endswith('.zip'))
+    return os.path.join(cache_dir, archives[0]) if archives else None
+
+
+def remove_stale_versions(dataset_dir, current_version, logger):
+    for version in os.listdir(dataset_dir):
+        if version != current_version:
+            logger.info(f"Removing cached dataset version '{version}'.")
+            shutil.rmtree(os.path.join(dataset_dir, version), ignore_errors=True)
+
+
+def extract_member(zip_file_path, file, dest_dir):
+    # Runs in a worker process - opens its own handle of the archive
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        member_info = zip_ref.getinfo(file)
+        target_path = os.path.join(dest_dir, file)
+        temp_path = target_path + '.part'
+
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+        with zip_ref.open(member_info) as source, open(temp_path, "wb") as target:
+            shutil.copyfileobj(source, target, EXTRACT_CHUNK_SIZE)
+        os.replace(temp_path, target_path)
+
+    return {"name": file, "path": target_path, "size": member_info.file_size, "crc": member_info.CRC}
+
+
+def load_extraction_state(dest_dir):
+    state_path = os.path.join(dest_dir, EXTRACTION_STATE_FILE)
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_extraction_state(dest_dir, state):
+    os.makedirs(dest_dir, exist_ok=True)
+    state_path = os.path.join(dest_dir, EXTRACTION_STATE_FILE)
+    with open(state_path + '.part', 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + '.part', state_path)
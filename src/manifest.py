@@ -0,0 +1,236 @@
+import datetime
+import functools
+import os
+import sqlite3
+import threading
+
+from src.utils import file_sha256
+
+def synchronized(method):
+  # The manifest is shared by concurrently running pipeline tasks, one statement sequence at a time
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with self.lock:
+      return method(self, *args, **kwargs)
+  return wrapper
+
+class DownloadManifest:
+  # Persistent record of every Open-Meteo file, one row per station and year.
+  # Resume, size reporting and uploads read it instead of walking the data directories.
+  def __init__(self, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.path = path
+    self.lock = threading.RLock()
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    self.connection.row_factory = sqlite3.Row
+    self.connection.execute('''
+      CREATE TABLE IF NOT EXISTS openmeteo_files (
+        station_id TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        path TEXT,
+        status TEXT NOT NULL,
+        size INTEGER,
+        rows INTEGER,
+        sha256 TEXT,
+        fetched_at TEXT,
+        http_status INTEGER,
+        http_date TEXT,
+        content_type TEXT,
+        uploaded_at TEXT,
+        hdfs_path TEXT,
+        last_time TEXT,
+        PRIMARY KEY (station_id, year)
+      )
+    ''')
+    # Manifests created before delta ingestion lack the last ingested hour
+    columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(openmeteo_files)')}
+    if 'last_time' not in columns:
+      self.connection.execute('ALTER TABLE openmeteo_files ADD COLUMN last_time TEXT')
+    self.connection.execute('''
+      CREATE TABLE IF NOT EXISTS openmeteo_deltas (
+        path TEXT PRIMARY KEY,
+        station_id TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        rows INTEGER,
+        first_time TEXT,
+        last_time TEXT,
+        fetched_at TEXT,
+        uploaded_at TEXT,
+        hdfs_path TEXT
+      )
+    ''')
+    self.connection.execute('''
+      CREATE TABLE IF NOT EXISTS station_grid_cells (
+        station_id TEXT PRIMARY KEY,
+        latitude TEXT,
+        longitude TEXT,
+        grid_latitude TEXT,
+        grid_longitude TEXT,
+        resolution REAL,
+        updated_at TEXT
+      )
+    ''')
+    self.connection.commit()
+
+  @synchronized
+  def close(self):
+    self.connection.close()
+
+  @synchronized
+  def record_download(self, station_id, year, path, rows, http_info, last_time=None):
+    # A fresh download replaces the previous entry and resets its upload state
+    self.connection.execute('''
+      INSERT OR REPLACE INTO openmeteo_files
+        (station_id, year, path, status, size, rows, sha256, fetched_at, http_status, http_date, content_type,
+         last_time)
+      VALUES (?, ?, ?, 'complete', ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (station_id, year, path, os.path.getsize(path), rows, file_sha256(path), now_iso(),
+          http_info.get('status'), http_info.get('date'), http_info.get('content_type'), last_time))
+    self.connection.commit()
+
+  @synchronized
+  def record_failure(self, station_id, year):
+    # Keeps a complete entry intact, only marks stations that have nothing yet
+    self.connection.execute('''
+      INSERT INTO openmeteo_files (station_id, year, status, fetched_at)
+      VALUES (?, ?, 'failed', ?)
+      ON CONFLICT (station_id, year) DO UPDATE SET fetched_at = excluded.fetched_at
+      WHERE status != 'complete'
+    ''', (station_id, year, now_iso()))
+    self.connection.commit()
+
+  @synchronized
+  def record_upload(self, station_id, year, hdfs_path):
+    self.connection.execute('''
+      UPDATE openmeteo_files SET uploaded_at = ?, hdfs_path = ? WHERE station_id = ? AND year = ?
+    ''', (now_iso(), hdfs_path, station_id, year))
+    self.connection.commit()
+
+  @synchronized
+  def file_entry(self, station_id, year):
+    return self.connection.execute('''
+      SELECT * FROM openmeteo_files WHERE station_id = ? AND year = ? AND status = 'complete'
+    ''', (station_id, year)).fetchone()
+
+  @synchronized
+  def completed_files(self, year):
+    return self.connection.execute('''
+      SELECT * FROM openmeteo_files WHERE year = ? AND status = 'complete' ORDER BY station_id
+    ''', (year,)).fetchall()
+
+  @synchronized
+  def completed_stations(self, year):
+    rows = self.connection.execute('''
+      SELECT station_id FROM openmeteo_files WHERE year = ? AND status = 'complete'
+    ''', (year,))
+    return {row['station_id'] for row in rows}
+
+  @synchronized
+  def has_year(self, year):
+    row = self.connection.execute('SELECT 1 FROM openmeteo_files WHERE year = ? LIMIT 1', (year,)).fetchone()
+    return row is not None
+
+  @synchronized
+  def pending_uploads(self, year):
+    return self.connection.execute('''
+      SELECT * FROM openmeteo_files WHERE year = ? AND status = 'complete' AND uploaded_at IS NULL
+      ORDER BY station_id
+    ''', (year,)).fetchall()
+
+  @synchronized
+  def summary(self):
+    row = self.connection.execute('''
+      SELECT COUNT(*) AS file_count, COALESCE(SUM(size), 0) AS total_size
+      FROM openmeteo_files WHERE status = 'complete'
+    ''').fetchone()
+    return row['file_count'], row['total_size']
+
+  @synchronized
+  def import_directory(self, year, directory, filename_pattern):
+    # One-off adoption of files downloaded before the manifest existed
+    imported = 0
+    for filename in os.listdir(directory):
+      match = filename_pattern.match(filename)
+      if not match or int(match.group('year')) != year:
+        continue
+      path = os.path.join(directory, filename)
+      self.connection.execute('''
+        INSERT OR IGNORE INTO openmeteo_files (station_id, year, path, status, size, sha256, fetched_at)
+        VALUES (?, ?, ?, 'complete', ?, ?, ?)
+      ''', (match.group('station_id'), year, path, os.path.getsize(path), file_sha256(path), now_iso()))
+      imported += 1
+    self.connection.commit()
+    return imported
+
+  @synchronized
+  def record_delta(self, station_id, year, path, rows, first_time, last_time):
+    self.connection.execute('''
+      INSERT OR REPLACE INTO openmeteo_deltas (path, station_id, year, rows, first_time, last_time, fetched_at)
+      VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (path, station_id, year, rows, first_time, last_time, now_iso()))
+    self.connection.commit()
+
+  @synchronized
+  def record_delta_upload(self, path, hdfs_path):
+    self.connection.execute('''
+      UPDATE openmeteo_deltas SET uploaded_at = ?, hdfs_path = ? WHERE path = ?
+    ''', (now_iso(), hdfs_path, path))
+    self.connection.commit()
+
+  @synchronized
+  def pending_delta_uploads(self, year):
+    return self.connection.execute('''
+      SELECT * FROM openmeteo_deltas WHERE year = ? AND uploaded_at IS NULL ORDER BY path
+    ''', (year,)).fetchall()
+
+  @synchronized
+  def deltas_by_station(self, year):
+    deltas = {}
+    rows = self.connection.execute('''
+      SELECT * FROM openmeteo_deltas WHERE year = ? ORDER BY station_id, first_time
+    ''', (year,))
+    for row in rows:
+      deltas.setdefault(row['station_id'], []).append(row)
+    return deltas
+
+  @synchronized
+  def delta_years(self):
+    rows = self.connection.execute('SELECT DISTINCT year FROM openmeteo_deltas ORDER BY year')
+    return [row['year'] for row in rows]
+
+  @synchronized
+  def remove_deltas(self, paths):
+    self.connection.executemany('DELETE FROM openmeteo_deltas WHERE path = ?', [(path,) for path in paths])
+    self.connection.commit()
+
+  @synchronized
+  def last_ingested_times(self, year):
+    # Latest hour per station, from the yearly file or any delta on top of it.
+    # None means a yearly file exists whose last hour was never recorded.
+    last_times = {}
+    rows = self.connection.execute('''
+      SELECT station_id, last_time FROM openmeteo_files WHERE year = ? AND status = 'complete'
+    ''', (year,))
+    for row in rows:
+      last_times[row['station_id']] = row['last_time']
+    rows = self.connection.execute('''
+      SELECT station_id, MAX(last_time) AS last_time FROM openmeteo_deltas WHERE year = ? GROUP BY station_id
+    ''', (year,))
+    for row in rows:
+      if last_times.get(row['station_id']) is None or row['last_time'] > last_times[row['station_id']]:
+        last_times[row['station_id']] = row['last_time']
+    return last_times
+
+  @synchronized
+  def record_grid_cells(self, cell_of_station, resolution):
+    # Lineage of grid-deduplicated downloads: which cell a station's file came from
+    updated_at = now_iso()
+    self.connection.executemany('''
+      INSERT OR REPLACE INTO station_grid_cells
+        (station_id, latitude, longitude, grid_latitude, grid_longitude, resolution, updated_at)
+      VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(station_id, *cell, resolution, updated_at) for station_id, cell in cell_of_station.items()])
+    self.connection.commit()
+
+def now_iso():
+  return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
@@ -1,63 +1,410 @@
 import csv
+import datetime
+import email.utils
 import re
 import requests
+import shutil
+import threading
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def extract_lat_lon(pm10_file, metadata_file, output_file, logger):
+from src.http_client import create_session
+from src.manifest import DownloadManifest
+from src.ratelimit import RateLimiter
+from src.stations import load_station_index, match_pollutant_headers
+from src.utils import COMPRESSION_EXTENSIONS, open_text_reader, open_text_writer
 
-  # Extract cleaned station IDs from the PM10 header
-  with open(pm10_file, 'r', encoding='utf-8') as f:
-    reader = csv.reader(f)
-    header = next(reader)
-    raw_ids = [col.split('-')[0] for col in header[1:]]  # Skip 'Time' column
-    station_ids = [re.match(r'^[A-Za-z]+', station_id).group(0) if re.match(r'^[A-Za-z]+', station_id) else station_id for station_id in raw_ids]
+API_BASE_URL = "https://archive-api.open-meteo.com/v1/archive"
+TIMEZONE = "Europe%2FBerlin"
+DATA_PARAMS = [
+  "temperature_2m",
+  "relative_humidity_2m",
+  "precipitation",
+  "surface_pressure",
+  "wind_speed_10m",
+  "wind_direction_10m",
+  "direct_radiation"
+]
+RATE_LIMIT_PAUSE = 60
+# Longest pause a Retry-After header can ask for
+MAX_RATE_LIMIT_PAUSE = 60 * 60
+# ERA5-Land, the finest reanalysis behind the archive's best_match model
+GRID_RESOLUTION = 0.1
+CHUNK_SIZE = 64 * 1024
+# Allowed shortfall of hourly rows, covers DST shifts in local time
+MISSING_ROWS_TOLERANCE = 24
+PARTIAL_DIR = '.partial'
+MEASUREMENT_FILENAME_PATTERN = re.compile(r'^openmeteo_(?P<station_id>.+)_(?P<year>\d{4})\.csv(\.gz|\.zst)?$')
 
-  # Read metadata and store lat/long and IDs by StationID
-  metadata = {}
-  with open(metadata_file, 'r', encoding='utf-8') as f:
-    reader = csv.DictReader(f, delimiter=';')
-    for row in reader:
-      metadata[row['StationID']] = {
-        'lat': row['lat'],
-        'long': row['long'],
-        'Number': row['Number'],
-        'InternationalStationID': row['InternationalStationID']
-      }
+class IncompleteResponseError(ValueError):
+  # The body ended before its header blocks did, fetch_lines retries the request
+  pass
+
+def extract_lat_lon(pollutant_files, metadata_file, output_file, logger, cache_dir=None):
+  # Station set is the union of the headers of all pollutant files, in first-seen order
+  index = load_station_index(metadata_file, cache_dir, logger)
+  matches = match_pollutant_headers(pollutant_files, index)
 
   # Match and write to output file
+  seen = set()
   with open(output_file, 'w', newline='', encoding='utf-8') as f:
     writer = csv.writer(f)
     writer.writerow(['OriginalID', 'MatchedStationID', 'Latitude', 'Longitude', 'Number', 'InternationalStationID'])
 
-    for original_id, cleaned_id in zip(raw_ids, station_ids):
-      matched = False
-      for station_meta_id in metadata:
-        if cleaned_id in station_meta_id:
-          data = metadata[station_meta_id]
-          writer.writerow([original_id, station_meta_id, data['lat'], data['long'], data['Number'], data['InternationalStationID']])
-          matched = True
-          break
-      if not matched:
-        logger.info(f"Warning: Cleaned StationID {cleaned_id} (from {original_id}) not found in metadata.")
-
-def download_open_meteo_yearly_measurements(stations_file_path, base_output_dir, year, rate_limit, logger, fail_limit=10, request_delay=0.2):
-  output_dir = os.path.join(base_output_dir, str(year))
-  os.makedirs(output_dir, exist_ok=True)
-
-  api_base_url = "https://archive-api.open-meteo.com/v1/archive"
-  timezone = "Europe%2FBerlin"
-  data_params = [
-    "temperature_2m",
-    "relative_humidity_2m",
-    "precipitation",
-    "surface_pressure",
-    "wind_speed_10m",
-    "wind_direction_10m",
-    "direct_radiation"
-  ]
+    for pollutant_matches in matches.values():
+      for original_id, cleaned_id, station_meta_id in pollutant_matches:
+        if original_id in seen:
+          continue
+        seen.add(original_id)
+        if station_meta_id is None:
+          logger.info(f"Warning: Cleaned StationID {cleaned_id} (from {original_id}) not found in metadata.")
+          continue
+        data = index.metadata[station_meta_id]
+        writer.writerow([original_id, station_meta_id, data['lat'], data['long'], data['Number'], data['InternationalStationID']])
+
+def download_open_meteo_yearly_measurements(stations_file_path, base_output_dir, year, logger, rate_limiter=None,
+                                             max_workers=8, fail_limit=10, max_retries=5, batch_size=1, session=None,
+                                             compression=None, manifest=None, grid_resolution=None):
+  return download_open_meteo_measurements(stations_file_path, base_output_dir, [year], logger, rate_limiter,
+                                          max_workers, fail_limit, max_retries, batch_size, session, compression,
+                                          manifest, grid_resolution)
+
+def download_open_meteo_measurements(stations_file_path, base_output_dir, years, logger, rate_limiter=None,
+                                     max_workers=8, fail_limit=10, max_retries=5, batch_size=1, session=None,
+                                     compression=None, manifest=None, grid_resolution=None):
+  # Fetches the whole span of missing years in one request per batch and splits it into per-year files.
+  # With grid_resolution set, stations are snapped to the model grid and every cell is fetched once.
+  years = sorted(years)
+  output_dirs = {year: os.path.join(base_output_dir, str(year)) for year in years}
+  for output_dir in output_dirs.values():
+    os.makedirs(output_dir, exist_ok=True)
+
+  if rate_limiter is None:
+    rate_limiter = RateLimiter()
+  if session is None:
+    session = create_session(max_connections_per_host=max_workers)
+  if manifest is None:
+    manifest = DownloadManifest(os.path.join(base_output_dir, 'manifest.sqlite'))
 
   # Load station coordinates
+  stations = load_stations(stations_file_path)
+
+  # Leftovers of interrupted runs are never complete files. Each set of years has its own
+  # directory, so downloads of other years can run at the same time.
+  partial_dir = os.path.join(base_output_dir, PARTIAL_DIR, '-'.join(str(year) for year in sorted(years)))
+  shutil.rmtree(partial_dir, ignore_errors=True)
+  os.makedirs(partial_dir)
+
+  # Already downloaded files come from the manifest, directories are only
+  # scanned once to adopt files from runs that predate it
+  completed = {}
+  for year, output_dir in output_dirs.items():
+    if not manifest.has_year(year):
+      imported = manifest.import_directory(year, output_dir, MEASUREMENT_FILENAME_PATTERN)
+      if imported:
+        logger.info(f"Added {imported} existing files for {year} to the manifest")
+    completed[year] = manifest.completed_stations(year)
+
+  missing = []
+  missing_files = 0
+  skipped_calls = 0
+  for station in stations:
+    paths = {}
+    for year in years:
+      if station['OriginalID'] in completed[year]:
+        skipped_calls += 1
+      else:
+        filename = measurement_filename(station['OriginalID'], year, compression)
+        paths[year] = os.path.join(output_dirs[year], filename)
+    if paths:
+      missing.append((station, paths))
+      missing_files += len(paths)
+
+  # Request locations, each with the (station, file) targets its rows go to per year
+  if grid_resolution:
+    locations, cell_of_station = group_by_grid_cell(missing, grid_resolution)
+    manifest.record_grid_cells(cell_of_station, grid_resolution)
+    logger.info(f"{len(missing)} stations map to {len(locations)} grid cells")
+  else:
+    locations = [
+      (station, {year: [(station['OriginalID'], path)] for year, path in paths.items()})
+      for station, paths in missing
+    ]
+
+  # One request per batch of locations - the API takes comma separated coordinates
+  batches = [locations[i:i + batch_size] for i in range(0, len(locations), batch_size)]
+
+  logger.info(f"Years {years[0]}-{years[-1]}: {skipped_calls} files already downloaded, "
+              f"{missing_files} to fetch in {len(batches)} requests")
+  if not batches:
+    return True
+
+  # Keep max_workers requests in flight, all paced by the shared rate limiter
+  stop_event = threading.Event()
+  downloaded = 0
+  failed = []
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = {
+      executor.submit(download_batch, batch, session, rate_limiter, stop_event, max_retries, compression,
+                      partial_dir, logger): batch
+      for batch in batches
+    }
+    for future in as_completed(futures):
+      batch = futures[future]
+      committed = future.result()
+      if committed is not None:
+        for item in committed:
+          manifest.record_download(item['station_id'], item['year'], item['path'], item['rows'], item['http'],
+                                   item['last_time'])
+        downloaded += len(committed)
+        print(f"Skipped: {skipped_calls} Downloaded: {downloaded}/{missing_files}", end='\r')
+      else:
+        failed_stations = {station_id for _, targets in batch for year_targets in targets.values()
+                           for station_id, _ in year_targets}
+        for station_id in sorted(failed_stations):
+          failed.append(station_id)
+          logger.error(f"Failed to fetch data for {station_id}")
+        for _, targets in batch:
+          for year, year_targets in targets.items():
+            for station_id, _ in year_targets:
+              manifest.record_failure(station_id, year)
+        if len(failed) >= fail_limit and not stop_event.is_set():
+          logger.error(f"{len(failed)} stations failed, cancelling remaining downloads")
+          stop_event.set()
+
+  logger.info(f"Downloaded {downloaded}/{missing_files} files")
+  return not failed and downloaded == missing_files
+
+def download_batch(batch, session, rate_limiter, stop_event, max_retries, compression, partial_dir, logger):
+  batch_stations = [station for station, _ in batch]
+  batch_years = sorted({year for _, targets in batch for year in targets})
+  start_date = datetime.date(batch_years[0], 1, 1)
+  # The archive rejects dates in the future
+  end_date = min(datetime.date(batch_years[-1], 12, 31), datetime.date.today())
+
+  url = create_batch_request_url(start_date, end_date, API_BASE_URL, TIMEZONE, DATA_PARAMS, batch_stations)
+  cost = request_cost(len(batch_stations), len(DATA_PARAMS), (end_date - start_date).days + 1)
+
+  def handle_lines(lines, http_info):
+    return split_response_by_year(lines, batch, http_info, partial_dir, compression, logger)
+
+  try:
+    return fetch_lines(session, url, handle_lines, rate_limiter, stop_event, max_retries, logger, cost)
+  except ValueError as e:
+    logger.error(f"Cannot split response: {e}")
+    return None
+
+def fetch_lines(session, url, handle_lines, rate_limiter, stop_event, max_retries, logger, cost=1):
+  # 429 answers do not count as attempts - the limiter waits them out
+  attempt = 0
+  while attempt < max_retries:
+    if stop_event.is_set():
+      return None
+    rate_limiter.acquire(cost)
+    try:
+      with session.get(url, stream=True) as response:
+        if response.status_code == 429:
+          retry_after = retry_after_seconds(response.headers.get('Retry-After'), RATE_LIMIT_PAUSE)
+          logger.warning(f"Rate limit! Pausing requests for {retry_after:.0f} seconds")
+          rate_limiter.pause(retry_after)
+          continue
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+        http_info = {
+          'status': response.status_code,
+          'date': response.headers.get('Date'),
+          'content_type': response.headers.get('Content-Type')
+        }
+        return handle_lines(response.iter_lines(chunk_size=CHUNK_SIZE, decode_unicode=True), http_info)
+    except (requests.RequestException, IncompleteResponseError) as e:
+      attempt += 1
+      logger.warning(f"Request failed ({attempt}/{max_retries}): {e}")
+      time.sleep(min(2 ** attempt, 60))
+  return None
+
+def retry_after_seconds(value, default):
+  # Retry-After holds either seconds or an HTTP-date, anything else waits the default pause
+  if value is None:
+    return default
+  try:
+    seconds = float(value)
+  except ValueError:
+    try:
+      retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+      return default
+    if retry_at.tzinfo is None:
+      retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    seconds = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+  return min(max(seconds, 0), MAX_RATE_LIMIT_PAUSE)
+
+def split_response_by_year(lines, batch, http_info, partial_dir, compression=None, logger=None):
+  # batch holds (location, {year: [(station_id, path), ...]}) items.
+  # Data rows are grouped by location, so only one output file is open at a time.
+  # Files are written under a temp name and renamed once their row count checks out.
+  multi_location = len(batch) > 1
+  lines = iter(lines)
+  metadata_header, metadata_rows, data_header = read_response_header(lines, len(batch))
+
+  written = []
+  current = None
+  try:
+    for line in lines:
+      if not line:
+        continue
+      location_id, row = split_location_row(line, multi_location)
+
+      key = (location_id, int(row[:4]))
+      if current is None or key != current['key']:
+        if current and current['file']:
+          current['file'].close()
+        current = {'key': key, 'file': None, 'rows': 0, 'last_time': None}
+        targets = batch[location_id][1].get(key[1])
+        if not targets:
+          # Year was already downloaded for this location
+          continue
+        current['targets'] = targets
+        current['location'] = batch[location_id][0]
+        current['metadata_row'] = metadata_rows[location_id]
+        current['temp_path'] = os.path.join(partial_dir, os.path.basename(targets[0][1]) + '.part')
+        current['file'] = open_text_writer(current['temp_path'], compression)
+        metadata_row = station_metadata_row(metadata_header, current['metadata_row'], current['location'],
+                                            targets[0][0])
+        current['file'].write(f"{metadata_header}\n{metadata_row}\n\n{data_header}\n")
+        written.append(current)
+
+      if current['file']:
+        current['file'].write(row + '\n')
+        current['rows'] += 1
+        if row_has_values(row):
+          current['last_time'] = row.split(',', 1)[0]
+  except BaseException:
+    if current and current['file']:
+      current['file'].close()
+    for item in written:
+      os.remove(item['temp_path'])
+    raise
+
+  if current and current['file']:
+    current['file'].close()
+
+  committed = []
+  for item in written:
+    year = item['key'][1]
+    first_path = item['targets'][0][1]
+    if item['rows'] < expected_rows(year):
+      if logger:
+        logger.warning(f"Discarding {os.path.basename(first_path)}: {item['rows']} rows, "
+                       f"expected at least {expected_rows(year)}")
+      os.remove(item['temp_path'])
+      continue
+
+    os.replace(item['temp_path'], first_path)
+    # Stations sharing a grid cell get copies of the same data under their own coordinates
+    for station_id, path in item['targets'][1:]:
+      copy_temp_path = os.path.join(partial_dir, os.path.basename(path) + '.part')
+      with open_text_reader(first_path) as source, open_text_writer(copy_temp_path, compression) as target:
+        metadata_header = next(source).rstrip('\n')
+        next(source)
+        metadata_row = station_metadata_row(metadata_header, item['metadata_row'], item['location'], station_id)
+        target.write(f"{metadata_header}\n{metadata_row}\n")
+        shutil.copyfileobj(source, target)
+      os.replace(copy_temp_path, path)
+
+    for station_id, path in item['targets']:
+      committed.append({
+        'station_id': station_id,
+        'year': year,
+        'path': path,
+        'rows': item['rows'],
+        'last_time': item['last_time'],
+        'http': http_info
+      })
+  return committed
+
+def group_by_grid_cell(missing, resolution):
+  # Stations snapped to the same cell center share one request location.
+  # The cell center is requested so elevation downscaling is the same for all of them;
+  # it is only the request key, the files keep each station's own coordinates (Stations).
+  cells = {}
+  cell_of_station = {}
+  for station, paths in missing:
+    latitude = snap_to_grid(station['Latitude'], resolution)
+    longitude = snap_to_grid(station['Longitude'], resolution)
+    cell_of_station[station['OriginalID']] = (station['Latitude'], station['Longitude'], latitude, longitude)
+    if (latitude, longitude) not in cells:
+      cells[(latitude, longitude)] = ({'OriginalID': f"cell_{latitude}_{longitude}",
+                                       'Latitude': latitude, 'Longitude': longitude, 'Stations': {}}, {})
+    cells[(latitude, longitude)][0]['Stations'][station['OriginalID']] = (station['Latitude'], station['Longitude'])
+    targets = cells[(latitude, longitude)][1]
+    for year, path in paths.items():
+      targets.setdefault(year, []).append((station['OriginalID'], path))
+  return list(cells.values()), cell_of_station
+
+def station_metadata_row(metadata_header, metadata_row, location, station_id):
+  # Metadata row of a grid cell with the station's latitude and longitude in place of the cell center's
+  coordinates = location.get('Stations', {}).get(station_id)
+  if coordinates is None:
+    return metadata_row
+  columns = metadata_header.split(',')
+  values = metadata_row.split(',')
+  for column, value in zip(('latitude', 'longitude'), coordinates):
+    if column in columns:
+      values[columns.index(column)] = value
+  return ','.join(values)
+
+def snap_to_grid(coordinate, resolution):
+  return f"{round(float(coordinate) / resolution) * resolution:.4f}"
+
+def read_response_header(lines, locations):
+  # Response layout: a metadata block, an empty line and the hourly data block.
+  # Multi-location responses prefix both blocks with a location_id column.
+  try:
+    metadata_header = next(lines)
+    metadata_rows = []
+    for line in lines:
+      if not line:
+        break
+      metadata_rows.append(line)
+    data_header = next(lines)
+  except StopIteration:
+    raise IncompleteResponseError('Response ended before its data header') from None
+
+  if locations > 1:
+    metadata_header = metadata_header.split(',', 1)[1]
+    metadata_rows = [row.split(',', 1)[1] for row in metadata_rows]
+    data_header = data_header.split(',', 1)[1]
+  if len(metadata_rows) != locations:
+    raise ValueError(f"Expected {locations} locations in response, got {len(metadata_rows)}")
+  return metadata_header, metadata_rows, data_header
+
+def split_location_row(line, multi_location):
+  if multi_location:
+    location_id, row = line.split(',', 1)
+    return int(location_id), row
+  return 0, line
+
+def row_has_values(row):
+  # Hours the archive has no data for yet come back with empty values
+  return any(row.split(',')[1:])
+
+def expected_rows(year):
+  # Past years must be complete, the current year only needs some data
+  if year >= datetime.date.today().year:
+    return 1
+  days = (datetime.date(year + 1, 1, 1) - datetime.date(year, 1, 1)).days
+  return days * 24 - MISSING_ROWS_TOLERANCE
+
+def measurement_filename(station_id, year, compression=None):
+  return f"openmeteo_{station_id}_{year}.csv{COMPRESSION_EXTENSIONS[compression]}"
+
+def request_cost(locations, variables, days):
+  # Open-Meteo counts calls fractionally: more than 10 variables or 2 weeks of data,
+  # and every extra location, weigh as additional calls
+  return locations * max(1.0, variables / 10) * max(1.0, days / 14)
+
+def load_stations(stations_file_path):
   stations = []
   with open(stations_file_path, 'r', encoding='utf-8') as f:
     reader = csv.DictReader(f)
@@ -67,49 +414,17 @@ def download_open_meteo_yearly_measurements(stations_file_path, base_output_dir,
         'Latitude': row['Latitude'],
         'Longitude': row['Longitude']
       })
-
-  # Get list of already downloaded files
-  existing_files = set(os.listdir(output_dir))
-
-  # Query API and save responses
-  calls_made = 0
-  skipped_calls = 0
-  num_fails = 0
-  run_was_successful = True
-  for station in stations:
-    calls_made += 1
-    filename = f"openmeteo_{station['OriginalID']}_{year}.csv"
-    if filename in existing_files:
-      skipped_calls += 1
-      continue
-
-    if calls_made >= rate_limit:
-      logger.warning("Rate limit reached. Exiting.")
-      break
-
-    url = create_request_url(year, api_base_url, timezone, data_params, station)
-
-    try:
-      response = requests.get(url)
-      response.raise_for_status()
-      with open(os.path.join(output_dir, filename), 'w', encoding='utf-8') as f:
-        f.write(response.text)
-      # logger.info(f"Saved data for {station['OriginalID']}")
-      print(f"Skipped: {skipped_calls} Downloaded: {calls_made}/{rate_limit}", end='\r')
-      time.sleep(request_delay)  # Small delay to avoid hitting rate limits
-    except requests.RequestException as e:
-      run_was_successful = False
-      num_fails += 1
-      # logger.error(f"Failed to fetch data for {station['OriginalID']}")
-      if num_fails >= fail_limit:
-        return False
-      
-  return run_was_successful
+  return stations
 
 def create_request_url(year, api_base_url, timezone, data_params, station):
-  url = f"{api_base_url}?latitude={station['Latitude']}"
-  url += f"&longitude={station['Longitude']}"
-  url += f"&start_date={year}-01-01&end_date={year}-12-31"
+  start_date = datetime.date(year, 1, 1)
+  end_date = datetime.date(year, 12, 31)
+  return create_batch_request_url(start_date, end_date, api_base_url, timezone, data_params, [station])
+
+def create_batch_request_url(start_date, end_date, api_base_url, timezone, data_params, stations):
+  url = f"{api_base_url}?latitude={','.join(station['Latitude'] for station in stations)}"
+  url += f"&longitude={','.join(station['Longitude'] for station in stations)}"
+  url += f"&start_date={start_date.isoformat()}&end_date={end_date.isoformat()}"
   url += f"&hourly={','.join(data_params)}"
   url += f"&timezone={timezone}"
   url += "&format=csv"
@@ -0,0 +1,219 @@
+import datetime
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src.http_client import create_session
+from src.openmeteo import API_BASE_URL, DATA_PARAMS, PARTIAL_DIR, TIMEZONE, create_batch_request_url, fetch_lines, \
+  load_stations, measurement_filename, read_response_header, request_cost, row_has_values, split_location_row
+from src.ratelimit import RateLimiter
+from src.utils import COMPRESSION_EXTENSIONS, compression_from_path, open_text_reader, open_text_writer
+
+DELTA_DIR = 'deltas'
+# The archive lags a few days behind, the previous year keeps getting its final days this long into the new one
+PAST_YEAR_INGEST_WINDOW = datetime.timedelta(days=31)
+
+def open_meteo_delta_years(manifest, today=None):
+  # The current year, the previous one early in the new year and any past year with deltas left to compact
+  today = today or datetime.date.today()
+  years = {today.year} | {year for year in manifest.delta_years() if year < today.year}
+  if today - datetime.date(today.year, 1, 1) < PAST_YEAR_INGEST_WINDOW and manifest.has_year(today.year - 1):
+    years.add(today.year - 1)
+  return sorted(years)
+
+def ingest_open_meteo_deltas(stations_file_path, base_output_dir, logger, manifest, rate_limiter=None, session=None,
+                             max_workers=8, max_retries=5, batch_size=1, compression=None, today=None, year=None):
+  # Requests only the hours after the last ingested one for every station of the year (the
+  # current one by default) and stores them as small delta files next to the yearly files.
+  # A past year only fetches what its stations still miss of their last days (archive lag).
+  today = today or datetime.date.today()
+  year = year or today.year
+  end_date = min(today, datetime.date(year, 12, 31))
+  delta_dir = os.path.join(base_output_dir, DELTA_DIR, str(year))
+  partial_dir = os.path.join(base_output_dir, PARTIAL_DIR)
+  os.makedirs(delta_dir, exist_ok=True)
+  os.makedirs(partial_dir, exist_ok=True)
+
+  if rate_limiter is None:
+    rate_limiter = RateLimiter()
+  if session is None:
+    session = create_session(max_connections_per_host=max_workers)
+
+  stations = load_stations(stations_file_path)
+  last_times = manifest.last_ingested_times(year)
+
+  # Stations sharing a window start can share one request
+  windows = {}
+  for station in stations:
+    station_id = station['OriginalID']
+    if year < today.year and station_id not in last_times:
+      continue
+    if station_id in last_times and last_times[station_id] is None:
+      # Yearly file adopted without its last hour - read it once
+      last_times[station_id] = last_time_in_file(manifest.file_entry(station_id, year)['path'])
+    last_time = last_times.get(station_id)
+    if last_time and last_time >= f"{year}-12-31T23:00":
+      continue
+    start_date = datetime.date.fromisoformat(last_time[:10]) if last_time else datetime.date(year, 1, 1)
+    windows.setdefault(start_date, []).append(station)
+
+  batches = []
+  for start_date, window_stations in sorted(windows.items()):
+    for i in range(0, len(window_stations), batch_size):
+      batches.append((start_date, window_stations[i:i + batch_size]))
+
+  station_count = sum(len(batch_stations) for _, batch_stations in batches)
+  logger.info(f"Fetching {year} deltas for {station_count} stations in {len(batches)} requests")
+
+  stop_event = threading.Event()
+  ingested_rows = 0
+  failed = 0
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [
+      executor.submit(fetch_delta_batch, start_date, end_date, batch_stations, last_times, session, rate_limiter,
+                      stop_event, max_retries, delta_dir, partial_dir, compression, logger)
+      for start_date, batch_stations in batches
+    ]
+    for future in as_completed(futures):
+      deltas = future.result()
+      if deltas is None:
+        failed += 1
+        continue
+      for delta in deltas:
+        manifest.record_delta(delta['station_id'], year, delta['path'], delta['rows'], delta['first_time'],
+                              delta['last_time'])
+        ingested_rows += delta['rows']
+
+  logger.info(f"Ingested {ingested_rows} new hourly rows, {failed} requests failed")
+  return failed == 0
+
+def fetch_delta_batch(start_date, end_date, stations, last_times, session, rate_limiter, stop_event, max_retries,
+                      delta_dir, partial_dir, compression, logger):
+  url = create_batch_request_url(start_date, end_date, API_BASE_URL, TIMEZONE, DATA_PARAMS, stations)
+  cost = request_cost(len(stations), len(DATA_PARAMS), (end_date - start_date).days + 1)
+
+  def handle_lines(lines, http_info):
+    return write_delta_files(lines, stations, last_times, end_date.year, delta_dir, partial_dir, compression)
+
+  try:
+    return fetch_lines(session, url, handle_lines, rate_limiter, stop_event, max_retries, logger, cost)
+  except ValueError as e:
+    logger.error(f"Cannot split delta response: {e}")
+    return None
+
+def write_delta_files(lines, stations, last_times, year, delta_dir, partial_dir, compression=None):
+  # Keeps rows after the last ingested hour that already carry values, one delta file per station
+  multi_location = len(stations) > 1
+  lines = iter(lines)
+  metadata_header, metadata_rows, data_header = read_response_header(lines, len(stations))
+
+  rows_by_location = {location_id: [] for location_id in range(len(stations))}
+  for line in lines:
+    if not line:
+      continue
+    location_id, row = split_location_row(line, multi_location)
+    row_time = row.split(',', 1)[0]
+    last_time = last_times.get(stations[location_id]['OriginalID'])
+    if row_time.startswith(str(year)) and (last_time is None or row_time > last_time) and row_has_values(row):
+      rows_by_location[location_id].append(row)
+
+  deltas = []
+  for location_id, rows in rows_by_location.items():
+    if not rows:
+      continue
+    station_id = stations[location_id]['OriginalID']
+    first_time = rows[0].split(',', 1)[0]
+    last_time = rows[-1].split(',', 1)[0]
+    filename = delta_filename(station_id, year, first_time, last_time, compression)
+    path = os.path.join(delta_dir, filename)
+    temp_path = os.path.join(partial_dir, filename + '.part')
+    with open_text_writer(temp_path, compression) as f:
+      f.write(f"{metadata_header}\n{metadata_rows[location_id]}\n\n{data_header}\n")
+      for row in rows:
+        f.write(row + '\n')
+    os.replace(temp_path, path)
+    deltas.append({
+      'station_id': station_id,
+      'path': path,
+      'rows': len(rows),
+      'first_time': first_time,
+      'last_time': last_time
+    })
+  return deltas
+
+def compact_open_meteo_deltas(base_output_dir, year, manifest, logger, compression=None, min_deltas=7, today=None):
+  # Folds accumulated deltas into the yearly file. Stations with fewer than min_deltas
+  # deltas wait for the next run, unless the year is over.
+  # Returns the compacted deltas. They stay in the manifest (and in HDFS) until
+  # remove_compacted_deltas is called once the yearly file is uploaded; compacting them
+  # again meanwhile is harmless, rows already in the yearly file are skipped.
+  force = year < (today or datetime.date.today()).year
+  partial_dir = os.path.join(base_output_dir, PARTIAL_DIR)
+  os.makedirs(partial_dir, exist_ok=True)
+
+  compacted_stations = 0
+  compacted = []
+  for station_id, deltas in manifest.deltas_by_station(year).items():
+    if len(deltas) < min_deltas and not force:
+      continue
+
+    entry = manifest.file_entry(station_id, year)
+    if entry:
+      path = entry['path']
+      sources = [entry['path']] + [delta['path'] for delta in deltas]
+    else:
+      path = os.path.join(base_output_dir, str(year), measurement_filename(station_id, year, compression))
+      sources = [delta['path'] for delta in deltas]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = os.path.join(partial_dir, os.path.basename(path) + '.part')
+    rows = 0
+    last_time = None
+    with open_text_writer(temp_path, compression_from_path(path)) as target:
+      for index, source in enumerate(sources):
+        with open_text_reader(source) as f:
+          preamble = [next(f) for _ in range(4)]
+          if index == 0:
+            target.writelines(preamble)
+          # Hours without values are the archive lag of the original download,
+          # the deltas carry them now
+          for line in f:
+            row_time = line.split(',', 1)[0]
+            if row_has_values(line.rstrip('\n')) and (last_time is None or row_time > last_time):
+              target.write(line)
+              rows += 1
+              last_time = row_time
+    os.replace(temp_path, path)
+
+    manifest.record_download(station_id, year, path, rows, {}, last_time)
+    compacted.extend(deltas)
+    compacted_stations += 1
+
+  logger.info(f"Compacted deltas of {compacted_stations} stations into their {year} files")
+  return compacted
+
+def remove_compacted_deltas(deltas, manifest, hdfs, logger):
+  # Drops compacted deltas, remote copies first so a failed delete leaves them tracked for the next run
+  remote_paths = [delta['hdfs_path'] for delta in deltas if delta['hdfs_path']]
+  if remote_paths and not hdfs.delete(remote_paths):
+    logger.error(f"Cannot remove {len(remote_paths)} compacted deltas from HDFS, keeping them for the next run")
+    return False
+  manifest.remove_deltas([delta['path'] for delta in deltas])
+  for delta in deltas:
+    if os.path.exists(delta['path']):
+      os.remove(delta['path'])
+  return True
+
+def last_time_in_file(path):
+  last_time = None
+  with open_text_reader(path) as f:
+    for index, line in enumerate(f):
+      if index >= 4 and row_has_values(line.rstrip('\n')):
+        last_time = line.split(',', 1)[0]
+  return last_time
+
+def delta_filename(station_id, year, first_time, last_time, compression=None):
+  # HDFS paths cannot contain ':'
+  first = first_time.replace('-', '').replace(':', '')
+  last = last_time.replace('-', '').replace(':', '')
+  return f"openmeteo_{station_id}_{year}_delta_{first}_{last}.csv{COMPRESSION_EXTENSIONS[compression]}"
@@ -0,0 +1,98 @@
+import gzip
+import json
+import os
+import shutil
+
+from src.utils import COMPRESSION_EXTENSIONS, open_text_reader
+
+HDFS_BLOCK_SIZE = 128 * 1024 * 1024
+
+def pack_open_meteo_year(year, manifest, packed_dir, logger, block_size=HDFS_BLOCK_SIZE, compression='gzip'):
+  # Merges the per-station files of a year into container files of about one HDFS block:
+  #   openmeteo_{year}_part-NNNN.csv[.gz] - "station,time,<variables>" header, then every station's rows
+  #   openmeteo_{year}.index.json         - per station: file, byte offset, length, rows and location
+  # With gzip every station block is its own gzip member, so one station is read with a seek
+  # and the file as a whole is still a valid gzip stream.
+  entries = manifest.completed_files(year)
+  if not entries:
+    logger.info(f"No weather files to pack for {year}")
+    return None
+
+  year_dir = os.path.join(packed_dir, str(year))
+  temp_dir = year_dir + '.part'
+  shutil.rmtree(temp_dir, ignore_errors=True)
+  os.makedirs(temp_dir)
+
+  index = {'year': year, 'compression': compression, 'files': [], 'stations': {}}
+  header = None
+  part = None
+  try:
+    for entry in entries:
+      station_id = entry['station_id']
+      with open_text_reader(entry['path']) as f:
+        metadata_header = next(f).rstrip('\n').split(',')
+        metadata_row = next(f).rstrip('\n').split(',')
+        next(f)
+        data_header = next(f).rstrip('\n')
+        rows = [f"{station_id},{line}" for line in f if line.strip()]
+
+      if header is None:
+        header = f"station,{data_header}\n"
+      elif header != f"station,{data_header}\n":
+        raise ValueError(f"{entry['path']} has different columns than the other files of {year}")
+
+      if part is None or part.tell() >= block_size:
+        if part:
+          part.close()
+        name = f"openmeteo_{year}_part-{len(index['files']):04d}.csv{COMPRESSION_EXTENSIONS[compression]}"
+        part = open(os.path.join(temp_dir, name), 'wb')
+        part.write(encode_block(header, compression))
+        index['files'].append(name)
+
+      block = encode_block(''.join(row if row.endswith('\n') else row + '\n' for row in rows), compression)
+      location = dict(zip(metadata_header, metadata_row))
+      index['stations'][station_id] = {
+        'file': index['files'][-1],
+        'offset': part.tell(),
+        'length': len(block),
+        'rows': len(rows),
+        'latitude': location.get('latitude'),
+        'longitude': location.get('longitude'),
+        'elevation': location.get('elevation')
+      }
+      part.write(block)
+  except BaseException:
+    if part:
+      part.close()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    raise
+  part.close()
+
+  with open(os.path.join(temp_dir, f"openmeteo_{year}.index.json"), 'w', encoding='utf-8') as f:
+    json.dump(index, f, indent=1)
+
+  shutil.rmtree(year_dir, ignore_errors=True)
+  os.replace(temp_dir, year_dir)
+  logger.info(f"Packed {len(entries)} station files for {year} into {len(index['files'])} files")
+  return year_dir
+
+def encode_block(text, compression):
+  data = text.encode('utf-8')
+  if compression == 'gzip':
+    # A fixed mtime keeps unchanged stations byte-identical between runs, so the sync skips them
+    return gzip.compress(data, mtime=0)
+  if compression is None:
+    return data
+  raise ValueError(f"Packing does not support {compression} compression")
+
+def read_packed_station(packed_year_dir, year, station_id):
+  # Rows of one station, read with a single seek through the sidecar index
+  with open(os.path.join(packed_year_dir, f"openmeteo_{year}.index.json"), 'r', encoding='utf-8') as f:
+    index = json.load(f)
+  location = index['stations'][station_id]
+  with open(os.path.join(packed_year_dir, location['file']), 'rb') as f:
+    f.seek(location['offset'])
+    data = f.read(location['length'])
+  if index['compression'] == 'gzip':
+    data = gzip.decompress(data)
+  return data.decode('utf-8')
@@ -0,0 +1,112 @@
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+class Task:
+  def __init__(self, name, func, dependencies=(), checkpoint=True):
+    self.name = name
+    self.func = func
+    self.dependencies = list(dependencies)
+    self.checkpoint = checkpoint
+
+class Pipeline:
+  # Task DAG: a task starts as soon as all its dependencies finished, independent tasks run
+  # concurrently. A task fails by raising or returning False, its dependents are then skipped.
+  # Finished tasks are checkpointed, so a rerun after a failure resumes with what is left;
+  # a fully successful run clears the checkpoint and the next run starts from scratch.
+  # A checkpoint only counts while every upstream task counts as done too: whatever depends on
+  # a task that runs again (e.g. one with checkpoint=False) runs again as well.
+  def __init__(self, logger, checkpoint_path=None, max_workers=4):
+    self.logger = logger
+    self.checkpoint_path = checkpoint_path
+    self.max_workers = max_workers
+    self.tasks = {}
+
+  def add(self, name, func, dependencies=(), checkpoint=True):
+    if name in self.tasks:
+      raise ValueError(f"Task {name} is already defined")
+    unknown = [dependency for dependency in dependencies if dependency not in self.tasks]
+    if unknown:
+      raise ValueError(f"Task {name} depends on unknown tasks: {', '.join(unknown)}")
+    self.tasks[name] = Task(name, func, dependencies, checkpoint)
+    return name
+
+  def run(self):
+    # Returns True when every task succeeded
+    completed = self.load_checkpoint()
+    done = set()
+    # Tasks are added after their dependencies, so one pass in order resolves whole chains
+    for task in self.tasks.values():
+      if task.name in completed and all(dependency in done for dependency in task.dependencies):
+        done.add(task.name)
+    completed = set(done)
+    if done:
+      self.logger.info(f"Resuming pipeline, {len(done)} tasks already completed: {', '.join(sorted(done))}")
+    failed = set()
+    skipped = set()
+    running = {}
+    started_at = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      while True:
+        for task in self.tasks.values():
+          if task.name in done or task.name in failed or task.name in skipped or task.name in running.values():
+            continue
+          if any(dependency in failed or dependency in skipped for dependency in task.dependencies):
+            self.logger.warning(f"Skipping task {task.name}, a dependency failed")
+            skipped.add(task.name)
+          elif all(dependency in done for dependency in task.dependencies):
+            self.logger.info(f"Starting task {task.name}")
+            running[executor.submit(self.run_task, task)] = task.name
+
+        if not running:
+          break
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+          name = running.pop(future)
+          if future.result():
+            done.add(name)
+            if self.tasks[name].checkpoint:
+              completed.add(name)
+              self.save_checkpoint(completed)
+          else:
+            failed.add(name)
+
+    elapsed = time.monotonic() - started_at
+    if failed or skipped:
+      self.logger.error(f"Pipeline finished in {elapsed:.1f}s with failed tasks: {', '.join(sorted(failed))}"
+                        f"{' and skipped tasks: ' + ', '.join(sorted(skipped)) if skipped else ''}")
+      return False
+    self.logger.info(f"Pipeline finished in {elapsed:.1f}s")
+    if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+      os.remove(self.checkpoint_path)
+    return True
+
+  def run_task(self, task):
+    started_at = time.monotonic()
+    try:
+      result = task.func()
+    except Exception as e:
+      self.logger.exception(f"Task {task.name} failed: {e}")
+      return False
+    if result is False:
+      self.logger.error(f"Task {task.name} failed after {time.monotonic() - started_at:.1f}s")
+      return False
+    self.logger.info(f"Task {task.name} done in {time.monotonic() - started_at:.1f}s")
+    return True
+
+  def load_checkpoint(self):
+    if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+      return set()
+    with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+      return set(json.load(f)['completed'])
+
+  def save_checkpoint(self, completed):
+    if not self.checkpoint_path:
+      return
+    os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_path)), exist_ok=True)
+    temp_path = f"{self.checkpoint_path}.part"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+      json.dump({'completed': sorted(completed)}, f, indent=2)
+    os.replace(temp_path, self.checkpoint_path)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+# Open-Meteo free tier limits for non-commercial use
+OPEN_METEO_PER_MINUTE = 600
+OPEN_METEO_PER_HOUR = 5000
+OPEN_METEO_PER_DAY = 10000
+
+class TokenBucket:
+  def __init__(self, capacity, period):
+    self.capacity = capacity
+    self.rate = capacity / period
+    self.tokens = float(capacity)
+    self.updated = time.monotonic()
+
+  def refill(self, now):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def wait_time(self, now, cost):
+    self.refill(now)
+    # A single call can never cost more than a full bucket
+    cost = min(cost, self.capacity)
+    if self.tokens >= cost:
+      return 0.0
+    return (cost - self.tokens) / self.rate
+
+  def take(self, cost):
+    self.tokens -= min(cost, self.capacity)
+
+class RateLimiter:
+  # Token buckets for every window, shared by all worker threads.
+  # A request proceeds only when each window has enough tokens left.
+  def __init__(self, per_minute=OPEN_METEO_PER_MINUTE, per_hour=OPEN_METEO_PER_HOUR, per_day=OPEN_METEO_PER_DAY):
+    windows = [(per_minute, 60), (per_hour, 3600), (per_day, 86400)]
+    self.buckets = [TokenBucket(limit, period) for limit, period in windows if limit]
+    self.blocked_until = 0.0
+    self.lock = threading.Lock()
+
+  def acquire(self, cost=1):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        wait = max([self.blocked_until - now] + [bucket.wait_time(now, cost) for bucket in self.buckets])
+        if wait <= 0:
+          for bucket in self.buckets:
+            bucket.take(cost)
+          return
+      time.sleep(min(wait, 60))
+
+  def pause(self, seconds):
+    # Called when the server answers 429 - hold every worker back
+    with self.lock:
+      self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
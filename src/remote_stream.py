@@ -0,0 +1,73 @@
+import gzip
+import os
+import tarfile
+
+from src.utils import zstandard
+
+# Remote side of each codec, the tar stream is decompressed before it reaches the extracting command
+REMOTE_DECOMPRESS_COMMANDS = {
+  'zstd': 'zstd -d -c',
+  'gzip': 'gzip -d -c',
+  None: 'cat'
+}
+ZSTD_LEVEL = 3
+
+class ChannelWriter:
+  # File-like adapter so tarfile and the compressors write straight into an SSH channel
+  def __init__(self, channel):
+    self.channel = channel
+    self.closed = False
+    self.bytes_sent = 0
+
+  def write(self, data):
+    self.channel.sendall(data)
+    self.bytes_sent += len(data)
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    # Sends EOF, the remote command sees the end of its stdin
+    if not self.closed:
+      self.channel.shutdown_write()
+      self.closed = True
+
+def remote_compression(runner):
+  # zstd when both ends have it, gzip otherwise
+  if zstandard is not None and runner.run('command -v zstd', echo=False, capture=True).exit_status == 0:
+    return 'zstd'
+  return 'gzip'
+
+def stream_tree_to_remote(runner, local_dir, remote_command, logger, compression='zstd', skip=()):
+  # Tars local_dir on the fly, compresses it (zstd uses all cores) and pipes it over an SSH
+  # channel into remote_command's stdin. Nothing is written to disk on either side, so
+  # reading, compressing, sending and extracting all overlap.
+  command = runner.start(f"{REMOTE_DECOMPRESS_COMMANDS[compression]} | {remote_command}", label='stream')
+  writer = ChannelWriter(command.channel)
+  files = 0
+  try:
+    if compression == 'zstd':
+      compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).stream_writer(writer, closefd=False)
+    elif compression == 'gzip':
+      compressed = gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=1)
+    else:
+      compressed = writer
+    with tarfile.open(fileobj=compressed, mode='w|') as tar:
+      for dirpath, dirnames, filenames in os.walk(local_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+          path = os.path.join(dirpath, filename)
+          if os.path.abspath(path) in skip:
+            continue
+          tar.add(path, arcname=os.path.relpath(path, local_dir), recursive=False)
+          files += 1
+    if compressed is not writer:
+      compressed.close()
+  finally:
+    writer.close()
+
+  exit_status = runner.wait([command])[0]
+  if exit_status == 0:
+    logger.info(f"Streamed {files} files from {local_dir} ({writer.bytes_sent / (1024 ** 2):.2f} MB {compression or 'raw'})")
+  return exit_status == 0
@@ -0,0 +1,122 @@
+import json
+import os
+import posixpath
+import stat
+
+from src.sftp_transfer import upload_file_resumable
+from src.utils import file_sha256
+
+REMOTE_MANIFEST_FILE = '.deploy_manifest.json'
+SFTP_CHUNK_SIZE = 1024 * 1024
+# Larger files go through the chunked, parallel and resumable transfer
+RESUMABLE_UPLOAD_THRESHOLD = 32 * 1024 * 1024
+
+def sync_to_remote(sftp, local_root, files, folders, remote_root, logger, ignore=('__pycache__',), ssh_client=None,
+                   reconnect=None):
+  # Deploys files and folders (paths under local_root) to remote_root over SFTP without
+  # tearing the remote tree down. A manifest of sha256 per relative path lives next to the
+  # deployed files; only changed files are uploaded and only files that disappeared locally
+  # are removed. Anything else in remote_root (e.g. the venv) is left alone.
+  # With ssh_client, large files are uploaded with upload_file_resumable. When reconnect()
+  # re-established the connection meanwhile, a new SFTP session replaces the stale one.
+  local = list_local_tree(local_root, files, folders, ignore)
+  sftp = reopen_sftp(sftp, ssh_client)
+  manifest_path = posixpath.join(remote_root, REMOTE_MANIFEST_FILE)
+  remote = load_remote_manifest(sftp, manifest_path)
+  ensure_remote_dir(sftp, remote_root)
+  remote_sizes = remote_file_sizes(sftp, remote_root, {posixpath.dirname(path) for path in local})
+
+  report = {'uploaded': [], 'deleted': [], 'unchanged': 0}
+  manifest = {}
+  for relative_path, local_path in sorted(local.items()):
+    sha256 = file_sha256(local_path)
+    manifest[relative_path] = sha256
+    # A file removed or altered remotely is uploaded again even if the manifest lists it
+    if remote.get(relative_path) == sha256 and remote_sizes.get(relative_path) == os.path.getsize(local_path):
+      report['unchanged'] += 1
+      continue
+    remote_path = posixpath.join(remote_root, relative_path)
+    if ssh_client and os.path.getsize(local_path) >= RESUMABLE_UPLOAD_THRESHOLD:
+      ensure_remote_dir(sftp, posixpath.dirname(remote_path))
+      upload_file_resumable(ssh_client, local_path, remote_path, logger, reconnect)
+      sftp = reopen_sftp(sftp, ssh_client)
+    else:
+      upload_file(sftp, local_path, remote_path)
+    report['uploaded'].append(relative_path)
+
+  for relative_path in sorted(set(remote) - set(manifest)):
+    try:
+      sftp.remove(posixpath.join(remote_root, relative_path))
+    except FileNotFoundError:
+      pass
+    report['deleted'].append(relative_path)
+
+  save_remote_manifest(sftp, manifest_path, manifest)
+  logger.info(f"Deployed to {remote_root}: {len(report['uploaded'])} uploaded, {len(report['deleted'])} deleted, "
+              f"{report['unchanged']} unchanged")
+  return report
+
+def reopen_sftp(sftp, ssh_client):
+  if ssh_client and sftp.get_channel().closed:
+    return ssh_client.open_sftp()
+  return sftp
+
+def list_local_tree(local_root, files, folders, ignore=()):
+  # {relative posix path: local path}
+  local = {}
+  for file in files:
+    local[os.path.relpath(file, local_root).replace(os.sep, '/')] = str(file)
+  for folder in folders:
+    for dirpath, dirnames, filenames in os.walk(folder):
+      dirnames[:] = [dirname for dirname in dirnames if dirname not in ignore]
+      for filename in filenames:
+        if filename in ignore or filename.endswith('.pyc'):
+          continue
+        path = os.path.join(dirpath, filename)
+        local[os.path.relpath(path, local_root).replace(os.sep, '/')] = path
+  return local
+
+def load_remote_manifest(sftp, manifest_path):
+  try:
+    with sftp.open(manifest_path, 'r') as f:
+      return json.loads(f.read().decode('utf-8'))
+  except (FileNotFoundError, ValueError):
+    return {}
+
+def save_remote_manifest(sftp, manifest_path, manifest):
+  temp_path = f"{manifest_path}.part"
+  with sftp.open(temp_path, 'w') as f:
+    f.write(json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+  sftp.posix_rename(temp_path, manifest_path)
+
+def remote_file_sizes(sftp, remote_root, relative_dirs):
+  # One listing per deployed directory instead of a stat per file
+  sizes = {}
+  for relative_dir in relative_dirs:
+    try:
+      entries = sftp.listdir_attr(posixpath.join(remote_root, relative_dir))
+    except FileNotFoundError:
+      continue
+    for entry in entries:
+      if stat.S_ISREG(entry.st_mode):
+        sizes[posixpath.join(relative_dir, entry.filename)] = entry.st_size
+  return sizes
+
+def ensure_remote_dir(sftp, remote_dir):
+  try:
+    sftp.stat(remote_dir)
+  except FileNotFoundError:
+    ensure_remote_dir(sftp, posixpath.dirname(remote_dir))
+    sftp.mkdir(remote_dir)
+
+def upload_file(sftp, local_path, remote_path):
+  # Pipelined writes do not wait for each chunk's acknowledgement; the file is renamed into
+  # place only when complete, so a running job never sees half a module
+  ensure_remote_dir(sftp, posixpath.dirname(remote_path))
+  temp_path = f"{remote_path}.part"
+  with open(local_path, 'rb') as source, sftp.open(temp_path, 'wb') as target:
+    target.set_pipelined(True)
+    for chunk in iter(lambda: source.read(SFTP_CHUNK_SIZE), b''):
+      target.write(chunk)
+  sftp.chmod(temp_path, os.stat(local_path).st_mode & 0o777)
+  sftp.posix_rename(temp_path, remote_path)
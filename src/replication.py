@@ -0,0 +1,80 @@
+import threading
+import time
+
+REPLICATION_DEADLINE = 60 * 60
+REPLICATION_POLL_INTERVAL = 60
+
+class ReplicationVerifier:
+  # Watches DataNode re-replication of the uploaded paths in a background thread.
+  # Files are written with their final replication factor, so the pipeline never waits on it;
+  # wait() at the end of the run only fails when blocks are still missing after the deadline.
+  def __init__(self, hdfs, logger, deadline=REPLICATION_DEADLINE, poll_interval=REPLICATION_POLL_INTERVAL):
+    self.hdfs = hdfs
+    self.logger = logger
+    self.deadline = deadline
+    self.poll_interval = poll_interval
+    self.paths = []
+    self.lock = threading.Lock()
+    self.check_lock = threading.Lock()
+    self.stop_event = threading.Event()
+    self.thread = None
+    self.started_at = None
+    self.progress = {}
+
+  def watch(self, path):
+    # Upload tasks call this concurrently, only the first one starts the thread and the deadline
+    with self.lock:
+      if path not in self.paths:
+        self.paths.append(path)
+      if self.thread is None:
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name='replication-verifier', daemon=True)
+        self.thread.start()
+
+  def run(self):
+    while not self.stop_event.is_set():
+      self.check()
+      self.stop_event.wait(self.poll_interval)
+
+  def check(self):
+    with self.lock:
+      paths = list(self.paths)
+    with self.check_lock:
+      self.check_paths(paths)
+    return self.pending(paths)
+
+  def check_paths(self, paths):
+    for path in paths:
+      try:
+        counts = self.hdfs.under_replicated(path)
+      except Exception as e:
+        self.logger.warning(f"Replication check of {path} failed: {e}")
+        counts = None
+      if counts is None:
+        continue
+      under, total = counts
+      if self.progress.get(path) != counts:
+        self.logger.info(f"Replication of {path}: {total - under}/{total} blocks fully replicated")
+      self.progress[path] = counts
+
+  def pending(self, paths):
+    # Paths that are not known to be fully replicated yet. A missing path reports (0, 0)
+    # and counts as done, only a failed check keeps a path pending.
+    return [path for path in paths if self.progress.get(path, (1, 1))[0] > 0]
+
+  def wait(self):
+    # Blocks only for what is left of the deadline, returns True once every path is replicated
+    with self.lock:
+      if self.thread is None:
+        return True
+    while True:
+      pending = self.check()
+      if not pending:
+        self.stop_event.set()
+        return True
+      remaining = self.deadline - (time.monotonic() - self.started_at)
+      if remaining <= 0:
+        self.stop_event.set()
+        self.logger.error(f"Replication deadline passed with under-replicated blocks in: {', '.join(pending)}")
+        return False
+      time.sleep(min(self.poll_interval, remaining))
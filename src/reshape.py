@@ -0,0 +1,91 @@
+import csv
+import os
+import re
+import time
+
+from src.utils import COMPRESSION_EXTENSIONS, open_text_writer
+
+YEAR_PATTERN = re.compile(r'(19|20)\d{2}')
+
+def reshape_joint_files_to_long(joint_files, output_dir, logger, compression=None):
+  # Turns the wide Kaggle matrices (Time + one column per station) into long records
+  # time,station,pollutant,value partitioned as year=YYYY/station=ID/<pollutant>.csv.
+  # Empty cells are dropped.
+  os.makedirs(output_dir, exist_ok=True)
+  for joint_file in joint_files:
+    pollutant = os.path.basename(joint_file).split('_')[0]
+    marker = os.path.join(output_dir, f".{pollutant}_SUCCESS")
+    if os.path.exists(marker) and os.path.getmtime(marker) >= os.path.getmtime(joint_file):
+      logger.info(f"Long format of {pollutant} is up to date - skipping")
+      continue
+
+    start_time = time.time()
+    rows_in, records_out = reshape_joint_file(joint_file, pollutant, output_dir, compression)
+    with open(marker, 'w'):
+      pass
+    elapsed_time = time.time() - start_time
+    logger.info(f"Reshaped {pollutant}: {rows_in} rows into {records_out} records in {elapsed_time:.2f} s")
+
+def reshape_joint_file(joint_file, pollutant, output_dir, compression=None):
+  # Rows are ordered by time, so writers stay open for one year at a time
+  # and memory is bounded by the number of stations, not the file size.
+  filename = f"{pollutant}.csv{COMPRESSION_EXTENSIONS[compression]}"
+  writers = {}
+  written = []
+  current_year = None
+  finished_years = set()
+  rows_in = 0
+  records_out = 0
+
+  def close_writers():
+    for f, _ in writers.values():
+      f.close()
+    writers.clear()
+
+  try:
+    with open(joint_file, 'r', encoding='utf-8', newline='') as f:
+      reader = csv.reader(f)
+      header = next(reader)
+      stations = [column.split('-')[0] for column in header[1:]]  # Skip 'Time' column
+
+      for row in reader:
+        if not row:
+          continue
+        rows_in += 1
+        row_time = row[0]
+        year_match = YEAR_PATTERN.search(row_time)
+        if not year_match:
+          continue
+        year = year_match.group(0)
+        if year != current_year:
+          if year in finished_years:
+            raise ValueError(f"{joint_file} is not ordered by time - {year} appears twice")
+          close_writers()
+          if current_year:
+            finished_years.add(current_year)
+          current_year = year
+
+        for station, value in zip(stations, row[1:]):
+          if value == '':
+            continue
+          if station not in writers:
+            path = os.path.join(output_dir, f"year={year}", f"station={station}", filename)
+            temp_path = path + '.part'
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            target = open_text_writer(temp_path, compression)
+            writer = csv.writer(target, lineterminator='\n')
+            writer.writerow(['time', 'station', 'pollutant', 'value'])
+            writers[station] = (target, writer)
+            written.append((temp_path, path))
+          writers[station][1].writerow([row_time, station, pollutant, value])
+          records_out += 1
+  except BaseException:
+    close_writers()
+    for temp_path, _ in written:
+      os.remove(temp_path)
+    raise
+
+  close_writers()
+  for temp_path, path in written:
+    os.replace(temp_path, path)
+  return rows_in, records_out
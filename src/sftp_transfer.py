@@ -0,0 +1,161 @@
+import hashlib
+import os
+import queue
+import shlex
+import threading
+import time
+
+import paramiko
+
+from src.ssh import SSH_MAX_PACKET_SIZE, SSH_WINDOW_SIZE, SshCommandRunner
+
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+TRANSFER_WORKERS = 4
+MAX_RECONNECTS = 5
+# Send/verify rounds before chunks that keep differing fail the upload
+MAX_TRANSFER_ROUNDS = 5
+MAX_RECONNECT_DELAY = 60
+WRITE_BLOCK_SIZE = 256 * 1024
+
+# Prints the sha256 of every chunk of a remote file, one line per chunk
+REMOTE_CHUNK_HASH_SCRIPT = (
+  "import hashlib, sys\n"
+  "f = open(sys.argv[1], 'rb')\n"
+  "for chunk in iter(lambda: f.read(int(sys.argv[2])), b''):\n"
+  "  print(hashlib.sha256(chunk).hexdigest())\n"
+)
+
+def upload_file_resumable(ssh_client, local_path, remote_path, logger, reconnect=None,
+                          chunk_size=TRANSFER_CHUNK_SIZE, workers=TRANSFER_WORKERS, max_reconnects=MAX_RECONNECTS,
+                          max_rounds=MAX_TRANSFER_ROUNDS):
+  # Uploads a file as fixed-size chunks in parallel, each worker on its own SFTP channel of the
+  # same transport, into <remote_path>.part. A chunk counts as done once its remote sha256
+  # matches the local one, so after a dropped connection (reconnect() re-establishes ssh_client
+  # in place, with backoff) or a rerun only chunks that are missing or wrong are sent again.
+  # The complete file is renamed into place.
+  size = os.path.getsize(local_path)
+  local_hashes = local_chunk_hashes(local_path, chunk_size)
+  part_path = f"{remote_path}.part"
+  reconnects = 0
+  rounds = 0
+  # Chunks written completely by this call, trusted when the remote side cannot hash them
+  sent = set()
+  while True:
+    try:
+      sftp = open_sftp(ssh_client)
+      try:
+        pending = pending_chunks(ssh_client, sftp, part_path, size, local_hashes, chunk_size, sent, logger)
+        if not pending:
+          sftp.chmod(part_path, os.stat(local_path).st_mode & 0o777)
+          sftp.posix_rename(part_path, remote_path)
+          logger.info(f"Uploaded {local_path} to {remote_path} ({size / (1024 ** 2):.2f} MB)")
+          return True
+      finally:
+        sftp.close()
+      if rounds == max_rounds:
+        raise RuntimeError(f"Upload of {local_path} failed: {len(pending)} chunks still differ from the local file "
+                           f"after {max_rounds} rounds")
+      rounds += 1
+      logger.info(f"Sending {len(pending)} of {len(local_hashes)} chunks of {local_path}")
+      send_chunks(ssh_client.get_transport(), local_path, part_path, pending, chunk_size, workers, sent)
+    except (paramiko.SSHException, EOFError, OSError) as e:
+      if reconnect is None or reconnects == max_reconnects:
+        logger.error(f"Upload of {local_path} failed: {e}")
+        raise
+      logger.warning(f"Upload of {local_path} interrupted ({e}), reconnecting")
+      reconnects = reconnect_with_backoff(reconnect, reconnects, max_reconnects, logger)
+
+def reconnect_with_backoff(reconnect, reconnects, max_reconnects, logger):
+  # Calls reconnect() until it succeeds, waiting longer after every attempt. Returns the
+  # attempts used so far, the last error is raised once max_reconnects is reached.
+  while True:
+    reconnects += 1
+    time.sleep(min(2 ** reconnects, MAX_RECONNECT_DELAY))
+    try:
+      reconnect()
+      return reconnects
+    except (paramiko.SSHException, EOFError, OSError) as e:
+      if reconnects >= max_reconnects:
+        logger.error(f"Reconnecting failed {reconnects} times: {e}")
+        raise
+      logger.warning(f"Reconnecting failed ({reconnects}/{max_reconnects}): {e}")
+
+def open_sftp(ssh_client):
+  return paramiko.SFTPClient.from_transport(ssh_client.get_transport(), window_size=SSH_WINDOW_SIZE,
+                                            max_packet_size=SSH_MAX_PACKET_SIZE)
+
+def local_chunk_hashes(local_path, chunk_size):
+  with open(local_path, 'rb') as f:
+    return [hashlib.sha256(chunk).hexdigest() for chunk in iter(lambda: f.read(chunk_size), b'')]
+
+def remote_chunk_hashes(ssh_client, part_path, chunk_size, logger):
+  command = f"python3 -c {shlex.quote(REMOTE_CHUNK_HASH_SCRIPT)} {shlex.quote(part_path)} {chunk_size}"
+  result = SshCommandRunner(ssh_client.get_transport(), logger).run(command, echo=False, capture=True)
+  return result.stdout.split() if result.exit_status == 0 else None
+
+def pending_chunks(ssh_client, sftp, part_path, size, local_hashes, chunk_size, sent, logger):
+  # Indexes of chunks the remote part file does not hold yet
+  try:
+    remote_size = sftp.stat(part_path).st_size
+  except FileNotFoundError:
+    sftp.open(part_path, 'w').close()
+    return list(range(len(local_hashes)))
+  if remote_size > size:
+    sftp.truncate(part_path, size)
+  if remote_size == 0:
+    return list(range(len(local_hashes)))
+  remote_hashes = remote_chunk_hashes(ssh_client, part_path, chunk_size, logger)
+  if remote_hashes is None:
+    # Without python3 remotely nothing can be verified, only chunks this call wrote are kept
+    logger.warning(f"Cannot hash {part_path} remotely, resending the chunks not written in this run")
+    return [index for index in range(len(local_hashes)) if index not in sent]
+  return [index for index, local_hash in enumerate(local_hashes)
+          if index >= len(remote_hashes) or remote_hashes[index] != local_hash]
+
+def send_chunks(transport, local_path, part_path, chunk_indexes, chunk_size, workers, sent):
+  # Workers take chunks from a shared queue; the first error stops the rest and is re-raised.
+  # Chunks of a worker whose file closed cleanly (all writes acknowledged) are added to sent.
+  chunks = queue.Queue()
+  for index in chunk_indexes:
+    chunks.put(index)
+  errors = []
+
+  def worker():
+    sftp = None
+    written = []
+    try:
+      sftp = paramiko.SFTPClient.from_transport(transport, window_size=SSH_WINDOW_SIZE,
+                                                max_packet_size=SSH_MAX_PACKET_SIZE)
+      with open(local_path, 'rb') as source, sftp.open(part_path, 'r+b') as target:
+        # Pipelined writes do not wait for every block's acknowledgement
+        target.set_pipelined(True)
+        while not errors:
+          try:
+            index = chunks.get_nowait()
+          except queue.Empty:
+            break
+          source.seek(index * chunk_size)
+          target.seek(index * chunk_size)
+          remaining = chunk_size
+          while remaining:
+            block = source.read(min(WRITE_BLOCK_SIZE, remaining))
+            if not block:
+              break
+            target.write(block)
+            remaining -= len(block)
+          target.flush()
+          written.append(index)
+      sent.update(written)
+    except Exception as e:
+      errors.append(e)
+    finally:
+      if sftp:
+        sftp.close()
+
+  threads = [threading.Thread(target=worker) for _ in range(min(workers, len(chunk_indexes)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
@@ -0,0 +1,110 @@
+import codecs
+import select
+import sys
+
+# Large channel windows let the remote side keep writing while we are busy elsewhere
+SSH_WINDOW_SIZE = 16 * 1024 * 1024
+SSH_MAX_PACKET_SIZE = 32 * 1024
+SSH_READ_SIZE = 256 * 1024
+SELECT_TIMEOUT = 1.0
+
+class SshCommand:
+  # One remote command on its own channel. Output is echoed to the local console as it
+  # arrives (prefixed with the label when several commands share the console) and kept
+  # when capture is set.
+  def __init__(self, channel, command, label=None, echo=True, capture=False):
+    self.channel = channel
+    self.command = command
+    self.label = label
+    self.echo = echo
+    self.capture = capture
+    self.decoders = {stream: codecs.getincrementaldecoder('utf-8')('replace') for stream in ('stdout', 'stderr')}
+    self.partial_lines = {'stdout': '', 'stderr': ''}
+    self.output = {'stdout': [], 'stderr': []}
+    self.exit_status = None
+
+  @property
+  def stdout(self):
+    return ''.join(self.output['stdout'])
+
+  @property
+  def stderr(self):
+    return ''.join(self.output['stderr'])
+
+  def drain(self):
+    # Reads whatever is buffered without blocking
+    while self.channel.recv_ready():
+      self.write('stdout', self.channel.recv(SSH_READ_SIZE))
+    while self.channel.recv_stderr_ready():
+      self.write('stderr', self.channel.recv_stderr(SSH_READ_SIZE))
+
+  def write(self, stream, data, final=False):
+    text = self.decoders[stream].decode(data, final)
+    if self.capture:
+      self.output[stream].append(text)
+    if not self.echo or not text:
+      return
+    console = sys.stdout if stream == 'stdout' else sys.stderr
+    if self.label is None:
+      console.write(text)
+    else:
+      # Only whole lines get the label, so concurrent commands do not interleave mid-line
+      lines = (self.partial_lines[stream] + text).split('\n')
+      self.partial_lines[stream] = lines.pop()
+      console.write(''.join(f"[{self.label}] {line}\n" for line in lines))
+    console.flush()
+
+  def finished(self):
+    return (self.channel.exit_status_ready() and not self.channel.recv_ready()
+            and not self.channel.recv_stderr_ready())
+
+  def finish(self):
+    for stream in ('stdout', 'stderr'):
+      self.write(stream, b'', final=True)
+      if self.echo and self.label is not None and self.partial_lines[stream]:
+        console = sys.stdout if stream == 'stdout' else sys.stderr
+        console.write(f"[{self.label}] {self.partial_lines[stream]}\n")
+        self.partial_lines[stream] = ''
+    self.exit_status = self.channel.recv_exit_status()
+    self.channel.close()
+
+class SshCommandRunner:
+  # Runs remote commands on separate channels of one SSH transport. start() returns at once;
+  # wait() multiplexes the output of every running command with select() until the awaited
+  # ones exit, so long commands (apt, pip) progress while other steps run.
+  def __init__(self, transport, logger):
+    self.transport = transport
+    self.logger = logger
+    self.running = []
+
+  def start(self, command, working_dir=None, label=None, echo=True, capture=False):
+    if working_dir:
+      command = f"cd {working_dir} && {command}"
+    self.logger.info(f"Executing command: {command}")
+    channel = self.transport.open_session(window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE)
+    channel.exec_command(command)
+    ssh_command = SshCommand(channel, command, label, echo, capture)
+    self.running.append(ssh_command)
+    return ssh_command
+
+  def wait(self, commands=None):
+    # Returns the exit statuses of the given commands (all running ones by default)
+    commands = list(self.running) if commands is None else list(commands)
+    while any(command.exit_status is None for command in commands):
+      channels = [command.channel for command in self.running]
+      select.select(channels, [], [], SELECT_TIMEOUT)
+      for command in list(self.running):
+        command.drain()
+        if command.finished():
+          command.finish()
+          self.running.remove(command)
+          if command.exit_status == 0:
+            self.logger.info(f"Command succeeded: {command.command}")
+          else:
+            self.logger.error(f"Command failed with exit status {command.exit_status}: {command.command}")
+    return [command.exit_status for command in commands]
+
+  def run(self, command, working_dir=None, label=None, echo=True, capture=False):
+    ssh_command = self.start(command, working_dir, label, echo, capture)
+    self.wait([ssh_command])
+    return ssh_command
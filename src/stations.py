@@ -0,0 +1,121 @@
+import bisect
+import csv
+import json
+import os
+import re
+
+from src.utils import file_sha256
+
+STATION_PREFIX_PATTERN = re.compile(r'^[A-Za-z]+')
+NGRAM = 3
+
+class StationIndex:
+  # Lookup structure over the StationID keys of stations_metadata.csv:
+  # a dict for exact matches, a sorted key list for prefix matches (bisect)
+  # and a trigram index for substring matches.
+  def __init__(self, metadata, sorted_ids=None, ngrams=None):
+    self.metadata = metadata
+    self.sorted_ids = sorted_ids if sorted_ids is not None else sorted(metadata)
+    self.ngrams = ngrams if ngrams is not None else build_ngram_index(self.sorted_ids)
+
+  def exact(self, station_id):
+    return station_id if station_id in self.metadata else None
+
+  def prefix(self, prefix):
+    start = bisect.bisect_left(self.sorted_ids, prefix)
+    matches = []
+    # Indexes from the first match, slicing (or islice) would walk or copy the tail
+    for index in range(start, len(self.sorted_ids)):
+      station_id = self.sorted_ids[index]
+      if not station_id.startswith(prefix):
+        break
+      matches.append(station_id)
+    return matches
+
+  def substring(self, part):
+    if len(part) < NGRAM:
+      return [station_id for station_id in self.sorted_ids if part in station_id]
+    candidates = None
+    for i in range(len(part) - NGRAM + 1):
+      positions = self.ngrams.get(part[i:i + NGRAM], [])
+      candidates = set(positions) if candidates is None else candidates & set(positions)
+      if not candidates:
+        return []
+    return [self.sorted_ids[position] for position in sorted(candidates) if part in self.sorted_ids[position]]
+
+  def match(self, station_id):
+    # Exact match first, then the shortest key starting with the ID,
+    # then the shortest key containing it - ties broken alphabetically
+    if self.exact(station_id):
+      return station_id
+    for matches in (self.prefix(station_id), self.substring(station_id)):
+      if matches:
+        return min(matches, key=lambda key: (len(key), key))
+    return None
+
+  def to_json(self):
+    return {'metadata': self.metadata, 'sorted_ids': self.sorted_ids, 'ngrams': self.ngrams}
+
+def build_ngram_index(sorted_ids):
+  ngrams = {}
+  for position, station_id in enumerate(sorted_ids):
+    for gram in {station_id[i:i + NGRAM] for i in range(len(station_id) - NGRAM + 1)}:
+      ngrams.setdefault(gram, []).append(position)
+  return ngrams
+
+def read_stations_metadata(metadata_file):
+  # Read metadata and store lat/long and IDs by StationID
+  metadata = {}
+  with open(metadata_file, 'r', encoding='utf-8') as f:
+    reader = csv.DictReader(f, delimiter=';')
+    for row in reader:
+      metadata[row['StationID']] = {
+        'lat': row['lat'],
+        'long': row['long'],
+        'Number': row['Number'],
+        'InternationalStationID': row['InternationalStationID']
+      }
+  return metadata
+
+def load_station_index(metadata_file, cache_dir=None, logger=None):
+  # The built index is cached next to the metadata, keyed by the metadata file's hash
+  if cache_dir is None:
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(metadata_file)), '.cache')
+  metadata_hash = file_sha256(metadata_file)
+  cache_file = os.path.join(cache_dir, f"station_index_{metadata_hash[:16]}.json")
+
+  if os.path.exists(cache_file):
+    with open(cache_file, 'r', encoding='utf-8') as f:
+      cached = json.load(f)
+    if logger:
+      logger.info(f"Loaded station index from cache: {cache_file}")
+    return StationIndex(cached['metadata'], cached['sorted_ids'], cached['ngrams'])
+
+  index = StationIndex(read_stations_metadata(metadata_file))
+  os.makedirs(cache_dir, exist_ok=True)
+  temp_file = cache_file + '.part'
+  with open(temp_file, 'w', encoding='utf-8') as f:
+    json.dump(index.to_json(), f)
+  os.replace(temp_file, cache_file)
+  return index
+
+def read_header_station_ids(pollutant_file):
+  # Header columns look like <StationCode>-<suffix>, the cleaned ID is the leading letters
+  with open(pollutant_file, 'r', encoding='utf-8') as f:
+    header = next(csv.reader(f))
+  station_ids = []
+  for column in header[1:]:  # Skip 'Time' column
+    raw_id = column.split('-')[0]
+    prefix_match = STATION_PREFIX_PATTERN.match(raw_id)
+    station_ids.append((raw_id, prefix_match.group(0) if prefix_match else raw_id))
+  return station_ids
+
+def match_pollutant_headers(pollutant_files, index):
+  # Matched metadata StationID (or None) for every header column of every pollutant file
+  matches = {}
+  for pollutant_file in pollutant_files:
+    matches[str(pollutant_file)] = [
+      (raw_id, cleaned_id, index.match(cleaned_id))
+      for raw_id, cleaned_id in read_header_station_ids(pollutant_file)
+    ]
+  return matches
@@ -1,4 +1,12 @@
+import gzip
+import hashlib
 import subprocess
+import tempfile
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
 RED = "\033[91m"
 YELLOW = "\033[93m"
@@ -22,6 +30,95 @@ def run_local_command(command, logger):
     result = subprocess.run(command, shell=True, check=True,
                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     logger.info(result.stdout.decode())
+    return True
   except subprocess.CalledProcessError as e:
-    logger.Error(f"Command failed: {e.cmd}")
+    logger.error(f"Command failed: {e.cmd}")
     logger.info(e.stderr.decode())
+    return False
+  except OSError as e:
+    # The command could not start at all, e.g. its arguments are too long
+    logger.error(f"Command could not run: {e}")
+    return False
+
+def capture_local_command(command, logger, input=None):
+  # Like run_local_command, but hands the output back instead of logging it.
+  # input (bytes) is fed to the command's stdin.
+  try:
+    result = subprocess.run(command, shell=True, check=True, input=input,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result.stdout.decode()
+  except subprocess.CalledProcessError as e:
+    logger.error(f"Command failed: {e.cmd}")
+    logger.info(e.stderr.decode())
+    return None
+  except OSError as e:
+    logger.error(f"Command could not run: {e}")
+    return None
+
+def run_local_command_with_input(command, chunks, logger):
+  # Feeds the byte chunks to the command's stdin. Output goes to temp files,
+  # so a chatty command cannot block the pipe while we are still writing.
+  with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+    try:
+      process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
+    except OSError as e:
+      logger.error(f"Command could not run: {e}")
+      return False
+    try:
+      for chunk in chunks:
+        process.stdin.write(chunk)
+    except BrokenPipeError:
+      pass
+    finally:
+      try:
+        process.stdin.close()
+      except BrokenPipeError:
+        pass
+    return_code = process.wait()
+
+    stdout.seek(0)
+    stderr.seek(0)
+    if return_code != 0:
+      logger.error(f"Command failed: {command}")
+      logger.info(stderr.read().decode())
+      return False
+    logger.info(stdout.read().decode())
+    return True
+
+COMPRESSION_EXTENSIONS = {
+  None: '',
+  'gzip': '.gz',
+  'zstd': '.zst'
+}
+
+def compression_from_path(path):
+  for compression, extension in COMPRESSION_EXTENSIONS.items():
+    if compression and str(path).endswith(extension):
+      return compression
+  return None
+
+def open_text_writer(path, compression=None):
+  if compression == 'gzip':
+    return gzip.open(path, 'wt', encoding='utf-8', newline='')
+  if compression == 'zstd':
+    if zstandard is None:
+      raise RuntimeError("zstd compression requires the zstandard package")
+    return zstandard.open(path, 'wt', cctx=zstandard.ZstdCompressor(threads=-1), encoding='utf-8', newline='')
+  return open(path, 'w', encoding='utf-8', newline='')
+
+def open_text_reader(path):
+  compression = compression_from_path(path)
+  if compression == 'gzip':
+    return gzip.open(path, 'rt', encoding='utf-8', newline='')
+  if compression == 'zstd':
+    if zstandard is None:
+      raise RuntimeError("zstd decompression requires the zstandard package")
+    return zstandard.open(path, 'rt', encoding='utf-8', newline='')
+  return open(path, 'r', encoding='utf-8', newline='')
+
+def file_sha256(path, chunk_size=1024 * 1024):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()